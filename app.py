@@ -1,19 +1,226 @@
 import streamlit as st
 import json
+import asyncio
 from main import PlanningState, PlannerAgent  # 假設你的類別在這裡
-import pandas as pd
+from state.cache import StateCache, is_failed_state
+from state.semantic_cache import SemanticPlanCache
 
 # --- 網頁標題 ---
 st.set_page_config(page_title="🤖 AI 旅遊行程規劃師", layout="wide")
 st.title("🤖 AI 旅遊行程規劃師")
 st.caption("輸入您的需求，AI 將為您規劃出 CP 值最高的創意行程")
 
+
+# --- 快取 Agent：同一個 API key 只建立一次 PlannerAgent (含底層 LLM client) ---
+@st.cache_resource(show_spinner=False)
+def get_planner(api_key: str) -> PlannerAgent:
+    # 創意行程另外用一個語意快取：最佳選項相同時可重用之前的 LLM 輸出
+    creative_cache = SemanticPlanCache(api_key=api_key, db_path=".cache/semantic_itineraries.db")
+    return PlannerAgent(api_key=api_key, creative_cache=creative_cache)
+
+
+class UncachedPlan(Exception):
+    """搜尋階段失敗時拋出：st.cache_data 不會快取例外，暫時性的 API 錯誤不會被重播一整天"""
+
+    def __init__(self, state: dict):
+        super().__init__(state.get("final_itinerary", {}).get("error", "規劃失敗"))
+        self.state = state
+
+
+# --- 快取搜尋結果：相同需求 24 小時內直接回傳，不再重跑 LLM 規劃 + 旅遊 API (只快取成功的結果) ---
+@st.cache_data(ttl=24 * 60 * 60, show_spinner=False)
+def plan(query_key: str, _planner: PlannerAgent) -> dict:
+    # query_key 已經過正規化 (strip + casefold)；_planner 以底線開頭，不參與快取雜湊
+    state = PlanningState(user_query=query_key)
+    # 多日期的工具查詢會以 asyncio 並行執行；每個階段的結果也會存到 .cache/，重啟後可直接恢復
+    # 最後的創意行程改由 stream_creative_plan 串流產生
+    updated_state = asyncio.run(_planner.arun_pipeline(state, cache=StateCache(query_key), until="best_option"))
+    if is_failed_state(updated_state):
+        raise UncachedPlan(updated_state.model_dump())
+    return updated_state.model_dump()
+
+
+def stream_creative_plan(query_key: str, planner: PlannerAgent, searched: dict) -> dict:
+    # 創意行程的結果同樣存在 .cache/，相同需求不會重新呼叫 LLM
+    cache = StateCache(query_key)
+    cached_state = cache.resume("itinerary")
+    if cached_state is not None:
+        return cached_state.model_dump()
+
+    # 邊產生邊顯示 LLM 的輸出，不必盯著 spinner 等到整段回應完成
+    state = PlanningState.model_validate(searched)
+    with st.status("AI 正在發揮創意規劃行程...", expanded=True) as status:
+        st.write_stream(planner.stream_optimize(state))
+        status.update(label="創意行程規劃完成！", state="complete", expanded=False)
+    cache.persist("itinerary", state)
+    return state.model_dump()
+
+
+# --- 語意快取：意思相同但寫法不同的需求 (例如 "十月 東京 五天四夜" vs "10月 東京 5天4夜") 也能直接命中 ---
+@st.cache_resource(show_spinner=False)
+def get_semantic_cache(api_key: str) -> SemanticPlanCache:
+    return SemanticPlanCache(api_key=api_key)
+
+
+def get_cached_plan(query_key: str, planner: PlannerAgent, semantic_cache: SemanticPlanCache) -> dict:
+    # 語意快取只是加速用：embedding API 或 SQLite 出錯時當作沒命中，照常規劃
+    try:
+        embedding = semantic_cache.embed(query_key)
+        cached = semantic_cache.lookup(query_key, embedding)
+    except Exception as e:
+        print(f"--- 語意快取查詢失敗，略過快取: {e} ---")
+        embedding, cached = None, None
+    if cached is not None:
+        return cached
+
+    with st.spinner("AI 正在為您規劃中... (正在執行多日 API 查詢，請稍候 1-2 分鐘)"):
+        try:
+            searched = plan(query_key, planner)
+        except UncachedPlan as e:
+            # 失敗的結果照樣顯示，但不進入任何快取，下次會重新查詢
+            searched = e.state
+    final = stream_creative_plan(query_key, planner, searched)
+    # 只快取成功的規劃結果：與階段快取同一套判斷，創意行程失敗 (error_message) 或工具錯誤都不寫入
+    if embedding is not None and not is_failed_state(PlanningState.model_validate(final)):
+        try:
+            semantic_cache.store(query_key, final, embedding)
+        except Exception as e:
+            print(f"--- 寫入語意快取失敗，略過: {e} ---")
+    return final
+
+
+def format_activities(activities_list):
+    if isinstance(activities_list, list):
+        # 將 ["活動1", "活動2"] 變成 "• 活動1\n• 活動2"
+        return "\n".join([f"• {act}" for act in activities_list])
+    return str(activities_list)
+
+
+@st.cache_data(show_spinner=False)
+def build_itinerary_df(itinerary_list: list, as_text: bool = True) -> "pd.DataFrame":
+    # 4. st.table 只能顯示文字，先把 'activities' 列表格式化成多行文字
+    #    (在建立 DataFrame 前用 list comprehension 處理，避免 df.apply 逐列呼叫)；
+    #    互動表格 (st.dataframe) 則直接交給 ListColumn 在前端顯示列表，不需在 Python 端組字串
+    if as_text:
+        rows = [{**row, "activities": format_activities(row.get("activities"))} for row in itinerary_list]
+    else:
+        rows = itinerary_list
+
+    # 5. (關鍵) 將字典列表轉換為 Pandas DataFrame
+    #    pandas 只在顯示結果時才需要，延後匯入可縮短每次 rerun 的腳本時間
+    import pandas as pd
+    df = pd.DataFrame(rows)
+
+    # 6. (修正) 重新命名欄位，並包含 'theme'
+    if 'theme' in df.columns:
+        df = df.rename(columns={"day": "天數", "theme": "本日主題", "activities": "活動內容"})
+    else:
+        # Fallback if theme is missing
+        df = df.rename(columns={"day": "天數", "activities": "活動內容"})
+
+    # (修正) 設定索引，讓表格更乾淨
+    return df.set_index('天數')
+
+
+def build_render_ctx(final: dict) -> dict:
+    """把規劃結果整理成畫面需要的欄位，只在規劃完成時算一次"""
+    # 1. 獲取規劃結果中的 final_itinerary 字典
+    final_data = final.get("final_itinerary", {})
+
+    # 2. 檢查是否有錯誤
+    if "error" in final_data:
+        return {"status": "error", "error": final_data["error"]}
+
+    # 3. (修正) 檢查 'total_cost' (Python 算的) 和 'creative_plan' (LLM 算的)
+    if "total_cost" not in final_data or "creative_plan" not in final_data:
+        return {"status": "invalid", "raw": final_data}
+
+    # (修正) 從 creative_plan 中獲取 LLM 的總結與每日行程
+    creative_plan = final_data.get("creative_plan", {})
+    itinerary_list = creative_plan.get("itinerary", [])
+
+    return {
+        "status": "ok",
+        "title": creative_plan.get("title", "您的東京之旅"),
+        "summary": creative_plan.get("summary", "AI 規劃完成！"),
+        # 基本資訊 (來自 Python 的精確計算)
+        "date_range": final_data.get("date_range", "N/A"),
+        "cost": final_data.get("total_cost", "N/A"),
+        "cost_breakdown": final_data.get("cost_breakdown", ""),
+        # (修正) 應為 'flight' (單數)
+        "flight": final_data.get("flight", {}),
+        "hotel": final_data.get("hotel", {}),
+        "itinerary": itinerary_list,
+        "itinerary_df": build_itinerary_df(itinerary_list) if itinerary_list else None,
+        "tips": creative_plan.get("tips", "玩得開心！"),
+    }
+
+
+def render_result(ctx: dict):
+    st.subheader("📅 您的專屬行程總覽")
+
+    if ctx["status"] == "error":
+        st.warning(f"行程規劃失敗: {ctx['error']}")
+        return
+
+    if ctx["status"] == "invalid":
+        st.error("規劃結果異常：缺少 'total_cost' 或 'creative_plan' 欄位。")
+        # 原始資料只在展開時顯示，且直接傳入 dict，避免重複序列化
+        with st.expander("Raw JSON (debug)"):
+            st.json(ctx["raw"])
+        return
+
+    st.header(ctx["title"])
+    st.markdown(f"### {ctx['summary']}")
+
+    st.markdown(f"**🗓️ 最佳日期:** {ctx['date_range']}")
+    st.markdown(f"**💸 預估最低總花費:** `TWD {ctx['cost']}`")
+    st.caption(f"成本分析: {ctx['cost_breakdown']}")
+
+    col1, col2 = st.columns(2)
+
+    with col1:
+        # 顯示航班和飯店 (來自 Python 的精確計算)
+        st.markdown("---")
+        st.markdown("#### ✈️ 航班資訊 (CP值最佳)")
+        st.json(ctx["flight"])
+
+    with col2:
+        st.markdown("---")
+        st.markdown("#### 🏨 飯店資訊 (CP值最佳)")
+        st.json(ctx["hotel"])
+
+    # 顯示行程 (表格)
+    st.markdown("---")
+    st.markdown("#### 🗺️ 每日行程規劃")
+
+    itinerary_table = ctx["itinerary_df"]
+    if itinerary_table is None:
+        st.info("AI 未能產生每日行程。")
+    elif st.toggle("互動式表格 (可排序、捲動)", key="interactive_itinerary"):
+        # 使用者要求時才改用 st.dataframe，活動列表交給 ListColumn 顯示
+        st.dataframe(
+            build_itinerary_df(ctx["itinerary"], as_text=False),
+            use_container_width=True,
+            column_config={"活動內容": st.column_config.ListColumn("活動內容", width="large")},
+        )
+    else:
+        # 行程只有幾天，預設用靜態的 st.table 即可，不需要 st.dataframe 的互動元件
+        st.table(itinerary_table)
+
+    # (新增) 顯示 LLM 的 Tips
+    st.markdown("---")
+    st.info(f"💡 AI 貼心提醒：\n{ctx['tips']}")
+
+
 # --- 步驟 1: 獲取使用者輸入 ---
 default_query = "今年2025年的十二月我想去東京，幫我找最便宜的五天四夜行程，我對動漫和美食有興趣。"
 user_input = st.text_area("您的旅遊需求：", value=default_query, height=100)
 
 # --- 步驟 2: 建立執行按鈕 ---
-if st.button("開始規劃行程 🚀"):
+clicked = st.button("開始規劃行程 🚀")
+if clicked:
+    st.session_state.pop("render_ctx", None)
 
     if not user_input:
         st.error("請輸入您的旅遊需求！")
@@ -28,113 +235,28 @@ if st.button("開始規劃行程 🚀"):
             # 從 secrets 獲取 API key
             api_key = st.secrets["OPENAI_API_KEY"]
 
-            # 顯示載入動畫
-            with st.spinner("AI 正在為您規劃中... (正在執行多日 API 查詢，請稍候 1-2 分鐘)"):
-                # 1. 初始化狀態
-                state = PlanningState(user_query=user_input)
-
-                # 2. 建立 Agent
-                planner = PlannerAgent(api_key=api_key)
+            # 1. 取得 Agent (已快取，重跑腳本時不會重新建立)
+            planner = st.session_state.get("planner")
+            if planner is None or st.session_state.get("planner_api_key") != api_key:
+                planner = get_planner(api_key)
+                st.session_state["planner"] = planner
+                st.session_state["planner_api_key"] = api_key
 
-                # 3. 執行你的規劃流程
-                updated_state = planner.generate_initial_plan(state)
-                updated_state = planner.execute_plan(updated_state)
-                updated_state = planner.find_best_option(updated_state)
-                updated_state = planner.optimize_itinerary(updated_state)
+            # 2. 執行你的規劃流程 (相同或語意相近的需求會命中快取)；搜尋階段顯示載入動畫，創意行程則即時串流
+            final = get_cached_plan(user_input.strip().casefold(), planner, get_semantic_cache(api_key))
 
-            # --- 步驟 4: 顯示結果 ---
+            # 3. 結果只整理一次並存進 session_state，之後任何 rerun 都直接讀取，不再重新走訪規劃結果
+            st.session_state["render_ctx"] = build_render_ctx(final)
             st.success("🎉 您的行程規劃完成！")
 
-            st.subheader("📅 您的專屬行程總覽")
-
-            # 1. 獲取 Pydantic 模型中的 final_itinerary 字典
-            final_data = updated_state.model_dump().get("final_itinerary", {})
-
-            # 2. 檢查是否有錯誤
-            if "error" in final_data:
-                st.warning(f"行程規劃失敗: {final_data['error']}")
-
-            # 3. (修正) 檢查 'total_cost' (Python 算的) 和 'creative_plan' (LLM 算的)
-            elif "total_cost" in final_data and "creative_plan" in final_data:
-
-                # (修正) 從 creative_plan 中獲取 LLM 的總結
-                creative_plan = final_data.get("creative_plan", {})
-                st.header(creative_plan.get("title", "您的東京之旅"))
-                st.markdown(f"### {creative_plan.get('summary', 'AI 規劃完成！')}")
-
-                # 顯示基本資訊 (來自 Python 的精確計算)
-                date_range = final_data.get('date_range', 'N/A')
-                cost = final_data.get('total_cost', 'N/A')
-                cost_breakdown = final_data.get('cost_breakdown', '')
-
-                st.markdown(f"**🗓️ 最佳日期:** {date_range}")
-                st.markdown(f"**💸 預估最低總花費:** `TWD {cost}`")
-                st.caption(f"成本分析: {cost_breakdown}")
-
-                col1, col2 = st.columns(2)
-
-                with col1:
-                    # 顯示航班和飯店 (來自 Python 的精確計算)
-                    st.markdown("---")
-                    st.markdown("#### ✈️ 航班資訊 (CP值最佳)")
-                    # (修正) 應為 'flight' (單數)
-                    st.json(final_data.get("flight", {}))
-
-                with col2:
-                    st.markdown("---")
-                    st.markdown("#### 🏨 飯店資訊 (CP值最佳)")
-                    st.json(final_data.get("hotel", {}))  # 'hotel' (單數) 是正確的
-
-                # 顯示行程 (表格)
-                st.markdown("---")
-                st.markdown("#### 🗺️ 每日行程規劃")
-
-                # *** --- 【關鍵修正】--- ***
-                # (修正) 從 'creative_plan' 中提取 'itinerary'
-                itinerary_list = creative_plan.get("itinerary", [])
-                # *** --- 【修正完畢】--- ***
-
-                if itinerary_list:
-                    # 4. (關鍵) 將字典列表轉換為 Pandas DataFrame
-                    df = pd.DataFrame(itinerary_list)
-
-
-                    # 5. (可選) 格式化 'activities' 欄位，將列表變成多行文字
-                    def format_activities(activities_list):
-                        if isinstance(activities_list, list):
-                            # 將 ["活動1", "活動2"] 變成 "• 活動1\n• 活動2"
-                            return "\n".join([f"• {act}" for act in activities_list])
-                        return str(activities_list)
-
-
-                    df['activities'] = df['activities'].apply(format_activities)
-
-                    # 6. (修正) 重新命名欄位，並包含 'theme'
-                    if 'theme' in df.columns:
-                        df = df.rename(columns={"day": "天數", "theme": "本日主題", "activities": "活動內容"})
-                        # (修正) 設定索引，讓表格更乾淨
-                        st.dataframe(df.set_index('天數'), use_container_width=True)
-                    else:
-                        # Fallback if theme is missing
-                        df = df.rename(columns={"day": "天數", "activities": "活動內容"})
-                        st.dataframe(df.set_index('天數'), use_container_width=True)
-
-                else:
-                    st.info("AI 未能產生每日行程。")
-
-                # (新增) 顯示 LLM 的 Tips
-                st.markdown("---")
-                st.info(f"💡 AI 貼心提醒：\n{creative_plan.get('tips', '玩得開心！')}")
-
-            else:
-                st.error("規劃結果異常：缺少 'total_cost' 或 'creative_plan' 欄位。")
-                st.json(final_data)  # 顯示原始資料以供除錯
-
         except Exception as e:
             st.error(f"規劃過程中發生嚴重錯誤：{e}")
             import traceback
 
             st.code(traceback.format_exc())  # 顯示詳細的錯誤堆疊
 
-else:
-    st.info("請在上方輸入框中描述您的需求，然後點擊按鈕。")
\ No newline at end of file
+# --- 步驟 4: 顯示結果 ---
+if "render_ctx" in st.session_state:
+    render_result(st.session_state["render_ctx"])
+elif not clicked:
+    st.info("請在上方輸入框中描述您的需求，然後點擊按鈕。")
@@ -1,9 +1,14 @@
 import os
-import json
+import orjson
 import re
-from typing import List, Dict
-from datetime import datetime, timedelta
-import time
+import hashlib
+from typing import List, Dict, Optional, Iterator, Tuple
+from datetime import date
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import threading
+import httpx
+from cachetools import TTLCache
 
 # LangChain 導入
 from langchain_openai import ChatOpenAI
@@ -12,277 +17,505 @@ from langchain_openai import ChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate       # <-- 修正
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.tools import StructuredTool
+from langchain_community.cache import SQLiteCache
 
 # 導入你的工具
-from tools.search_flights import search_flights
+from tools.search_flights import search_flights, CITY_TO_AIRPORT_CODE
 from tools.search_hotel import search_hotels
 from tools.search_attractions import search_attractions
 
 # 導入你的狀態模型
 from state.model import PlanningState
+from state.cache import StateCache
+from state.semantic_cache import SemanticPlanCache
+from utils.dates import candidate_date_ranges
 
 # from dotenv import load_dotenv
 # load_dotenv()
 
+# 只讀取資料、沒有副作用的工具，結果可以安全快取
+INFORMATIONAL_TOOLS = {"search_flights", "search_hotels", "search_attractions"}
+# 票價與房價會變動，快取的工具結果最多保留 1 小時
+TOOL_CACHE_TTL = 60 * 60
+
+# 會直接產生 search_attractions 呼叫的興趣 -> 交給創意行程的景點欄位；
+# 創意行程提示只用得到這兩類景點，其他興趣查了也不會被使用 (而且每次都是付費 API 呼叫)
+INTEREST_KEYWORDS = {"動漫": "anime_spots", "美食": "food_spots"}
+DEFAULT_DEPARTURE_CITY = "台北"
+
+_ISO_DATE_RE = re.compile(r"\d{4}-\d{2}-\d{2}")
+
+# 規劃提示的第 3 條規則：Python 算得出日期範圍時直接提供；算不出來時 (例如指定的月份已經過去) 沿用原本交給 LLM 推算的說明
+_DATE_RANGES_RULE = "請使用以下日期範圍 (出發日 至 回程日)：{}"
+# 需求中沒有明確的「N月」時 (例如「下個月」、「12/20 出發」) 才使用，由 LLM 自行判斷日期
+_LLM_DATE_RULE = ("請依使用者請求提到的日期或月份 (例如「下個月」、「12/20 出發」) 生成多個使用者要求的日期範圍"
+                  "（例如 要求九月份的五天四夜則有 2025-09-01 到 2025-09-05、2025-09-06 到 2025-09-10 等，最多 5 個範圍）。")
+
+
+class _JsonObjectTracker:
+    """逐段餵入串流文字，回報最外層的 JSON 物件是否已經完整 (會略過字串內的括號)"""
+
+    def __init__(self):
+        self.depth = 0
+        self.started = False
+        self.in_string = False
+        self.escaped = False
+
+    def feed(self, text: str) -> bool:
+        for ch in text:
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif ch == "\\":
+                    self.escaped = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"':
+                self.in_string = self.started
+            elif ch == "{":
+                self.depth += 1
+                self.started = True
+            elif ch == "}" and self.started:
+                self.depth -= 1
+                if self.depth == 0:
+                    return True
+        return False
+
+
 class PlannerAgent:
-    def __init__(self, api_key: str , model_name: str = "gpt-4o"):
-        self.llm = ChatOpenAI(api_key=api_key , model=model_name, temperature=0.0)
+    # 提示模板只在類別載入時建立一次，不必每次呼叫都重新解析整段模板字串
+    PLAN_PROMPT = ChatPromptTemplate.from_messages(
+        [
+            (
+                "system",
+                """你是一位頂級的問題解決專家和專案規劃師。
+                你的任務是根據使用者的請求，生成一個搜尋計劃，並執行任務。
+
+                **重要規則**：
+                1. 每個工具的參數必須嚴格符合其定義的簽名和格式要求。
+                2. 日期參數（例如 departure_date, checkin_date, checkout_date）必須是有效的 YYYY-MM-DD 格式。
+                3. {date_rule}
+                4. 對於每個日期範圍，生成 search_flights 和 search_hotels 工具呼叫，確保 departure_date 等於 checkin_date，return_date 等於 checkout_date。
+                5. 只為使用者提到的「動漫」或「美食」興趣生成 search_attractions 工具呼叫 (其他興趣不需要搜尋)。
+                6. 請直接一次呼叫所有需要的工具（可同時呼叫多個），不需要輸出其他文字。
+                """,
+            ),
+            ("human", "這是我的請求：{query}"),
+        ]
+    )
+
+    # --- ***【錯誤修正】*** ---
+    # 1. 將 "human" 訊息改為 placeholder "{input_json}"
+    # 2. 將 system prompt 中所有範例的 {var} 改為 {{var}} 來跳脫
+    ITINERARY_PROMPT = ChatPromptTemplate.from_messages(
+        [
+            (
+                "system",
+                """你是一位頂級的東京旅遊規劃師，風格風趣且貼心。
+                你的任務不是計算價格（Python 已經算好了），而是將「數據」轉化為「美好的回憶」。
+
+                **你的輸入資料包含：**
+                1.  `user_query`: 使用者的原始需求 (例如：他對什麼感興趣)。
+                2.  `best_option_details`: Python 幫你算出的「CP值最高」的機票和飯店。
+                3.  `cost_analysis_summary`: (選用) 其他日期的價格，讓你知道這個選項有多划算。
+                4.  `anime_spots`: 動漫景點列表。
+                5.  `food_spots`: 美食景點列表。
+
+                **你的工作：**
+                1.  **總結與確認**：以熱情的口吻告訴使用者，你已經幫他找到了最划算的日期，並簡要總結航班和飯店 (例如：飯店的特色、評分)。
+                2.  **創意行程**：根據使用者的興趣 (例如 `user_query` 提到的動漫、美食)，將 `anime_spots` 和 `food_spots` 融合到與 `best_option_details` 的 date_range 天數相符的行程中。
+                3.  **主題包裝**：如果使用者提到特定興趣 (如動漫)，嘗試規劃一個「主題日」，例如「秋葉原動漫聖地巡禮日」。
+                4.  **動態應變**：(如果 `best_option_details` 中有 `error` 欄位) 程式在抓取資料時出錯了，你需要安撫使用者，並根據現有資訊提供替代方案 (例如：建議手動查詢 Airbnb，或更換景點)。
+
+                **輸出格式：** 必須是純 JSON 格式，不含任何 Markdown。
+                {{
+                    "title": "為你量身打造的東京五天四夜之旅！",
+                    "summary": "（你對這個行程的總結，例如：我幫你找到了 12/18 出發的最棒組合，住在超方便的新宿，總花費才 TWD XXXXX！）",
+                    "chosen_option": {{
+                        "date_range": "YYYY-MM-DD 至 YYYY-MM-DD",
+                        "total_cost": 12345,
+                        "flight": "（航班資訊，例如：搭乘 華航 CI100 前往成田）",
+                        "hotel": "（飯店資訊，例如：入住 新宿格拉斯麗飯店，評分 4.5/5，哥吉拉在等你！）」"
+                    }},
+                    "itinerary": [
+                        {{"day": 1, "theme": "抵達與探索", "activities": ["搭乘 {{flight}} 抵達東京", "入住 {{hotel}}", "晚餐：{{food_spot}}"]}},
+                        {{"day": 2, "theme": "動漫聖地巡禮", "activities": ["上午：{{anime_spot_1}}", "下午：{{anime_spot_2}}", "晚餐：{{food_spot}}"]}},
+                        {{"day": 3, "theme": "美食與文化", "activities": ["上午：{{spot_3}}", "下午：{{spot_4}}", "晚餐：{{food_spot}}"]}},
+                        {{"day": 4, "theme": "...待定...", "activities": ["..."]}},
+                        {{"day": 5, "theme": "伴手禮與返程", "activities": ["..."]}}
+                    ],
+                    "tips": "（給予使用者一些貼心提醒）"
+                }}
+                """
+            ),
+            # 1. (修正) 這裡使用 placeholder
+            ("human", "{input_json}"),
+        ]
+    )
+    # --- ***【修正結束】*** ---
+
+    def __init__(self, api_key: str , model_name: str = "gpt-4o",
+                 creative_cache: Optional[SemanticPlanCache] = None,
+                 llm_cache_path: Optional[str] = ".cache/llm_cache.db"):
+        # 共用的 HTTP 連線池 (HTTP/2 + keepalive)，連續呼叫 LLM 時不必每次重新做 TLS 握手
+        limits = httpx.Limits(max_keepalive_connections=20, keepalive_expiry=30)
+        # LLM 回應快取 (SQLite)：相同的 prompt + 模型參數直接回傳上次的回應，不再付費呼叫 API
+        # 只掛在這個 ChatOpenAI 上，不用 set_llm_cache 影響全域
+        llm_cache = None
+        if llm_cache_path:
+            os.makedirs(os.path.dirname(llm_cache_path) or ".", exist_ok=True)
+            llm_cache = SQLiteCache(database_path=llm_cache_path)
+        self.llm = ChatOpenAI(
+            api_key=api_key , model=model_name, temperature=0.0,
+            http_client=httpx.Client(http2=True, limits=limits),
+            http_async_client=httpx.AsyncClient(http2=True, limits=limits),
+            cache=llm_cache,
+        )
+        # (選用) 創意行程的語意快取：需求相近且最佳選項相同時，直接重用之前產生的行程
+        self.creative_cache = creative_cache
         # 包含景點搜尋工具
         self.tools = [search_flights, search_hotels, search_attractions]
-        # 綁定工具到 LLM
-        self.llm = self.llm.bind_tools(self.tools)
-        self.available_tools = """
-        - search_flights(departure_city: str, destination_city: str, departure_date: str, return_date: str = None): 搜尋航班資訊。departure_date 和 return_date 必須是 YYYY-MM-DD 格式，return_date 可選。
-        - search_hotels(destination: str, checkin_date: str, checkout_date: str, sort_by: str = 'price', sort_order: str = 'asc'): 搜尋飯店資訊。checkin_date 和 checkout_date 必須是 YYYY-MM-DD 格式，sort_by 必須是 'price'、'rating' 或 'reviews'，sort_order 必須是 'asc' 或 'desc'。
-        - search_attractions(destination: str, interest: str): 搜尋指定目的地的興趣相關景點（例如 '動漫' 或 '美食'）。
-        """
+        self._tool_by_name: Dict[str, StructuredTool] = {t.name: t for t in self.tools}
+        # 計劃步驟的驗證函數，以工具名稱查表
+        self._step_validators = {
+            "search_flights": self._validate_flight_call,
+            "search_hotels": self._validate_hotel_call,
+            "search_attractions": self._validate_attraction_call,
+        }
+        # 工具結果快取：key 為 (工具名稱, 參數) 的雜湊；Agent 會被 app 重複使用，
+        # 因此加上 TTL 與筆數上限，跨次執行的相同查詢也能命中，但不會一直用到過期的價格
+        self._tool_cache: TTLCache = TTLCache(maxsize=1024, ttl=TOOL_CACHE_TTL)
+        self._tool_cache_lock = threading.Lock()  # TTLCache 本身不是執行緒安全的
+        # 工具呼叫 (SerpApi HTTP 請求) 專用的執行緒池，不受預設執行緒池大小 (依 CPU 數) 限制
+        self._tool_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="planner-tool")
+        # 綁定工具到規劃用的 LLM，讓模型一次回傳多個結構化的 tool call；
+        # self.llm 本身不綁工具，給創意行程使用
+        self.planner_llm = self.llm.bind_tools(self.tools, parallel_tool_calls=True)
+        self.itinerary_chain = self.ITINERARY_PROMPT | self.llm | StrOutputParser()
 
     @staticmethod
     def is_valid_date(date_str: str) -> bool:
+        # 先用長度與 "-" 位置判斷 YYYY-MM-DD 形狀，再直接建 date 驗證，不必經過 strptime 的格式解析
+        if len(date_str) != 10 or date_str[4] != "-" or date_str[7] != "-":
+            return False
         try:
-            datetime.strptime(date_str, "%Y-%m-%d")
+            date(int(date_str[:4]), int(date_str[5:7]), int(date_str[8:10]))
             return True
         except ValueError:
             return False
 
-    def generate_initial_plan(self, current_state: PlanningState) -> PlanningState:
-        prompt_template = ChatPromptTemplate.from_messages(
-            [
-                (
-                    "system",
-                    """你是一位頂級的問題解決專家和專案規劃師。
-                    你的任務是根據使用者的請求，生成一個搜尋計劃，並執行任務。
-                    你擁有以下工具可以使用：
-                    {tools}
-
-                    **重要規則**：
-                    1. 每個工具的參數必須嚴格符合其定義的簽名和格式要求。
-                    2. 日期參數（例如 departure_date, checkin_date, checkout_date）必須是有效的 YYYY-MM-DD 格式。
-                    3. 使用者請求提到「某月份」，請在這個月份生成多個使用者要求的日期範圍（例如 要求九月份的五天四夜則有 2025-09-01 到 2025-09-05、2025-09-06 到 2025-09-10 等，最多 5 個範圍）。
-                    4. 對於每個日期範圍，生成 search_flights 和 search_hotels 工具呼叫，確保 departure_date 等於 checkin_date，return_date 等於 checkout_date。
-                    5. 為興趣生成 search_attractions 工具呼叫。
-                    6. 確保計劃中的工具呼叫語法正確，例如：search_flights(departure_city="台北", destination_city="東京", departure_date="2025-09-01", return_date="2025-09-05")。
-                    7. 你的回答必須是純 JSON 格式，不包含任何額外的文字或 Markdown 標記（例如 ```json 或 ```）。
-
-                    JSON 格式必須是：
-                    {{
-                        "plan": ["工具呼叫1", "工具呼叫2", ...]
-                    }}
-                    """,
-                ),
-                ("human", "這是我的請求：{query}"),
-            ]
-        )
+    def _validate_flight_call(self, args: Dict) -> bool:
+        if not self.is_valid_date(args.get("departure_date") or ""):
+            print(f"--- 無效的日期格式在 {args}，跳過此步驟 ---")
+            return False
+        return_date = args.get("return_date")
+        if return_date not in (None, "None") and not self.is_valid_date(return_date):
+            print(f"--- 無效的回程日期格式在 {args}，跳過此步驟 ---")
+            return False
+        return True
 
-        chain = prompt_template | self.llm | StrOutputParser()
+    def _validate_hotel_call(self, args: Dict) -> bool:
+        if not self.is_valid_date(args.get("checkin_date") or "") or not self.is_valid_date(args.get("checkout_date") or ""):
+            print(f"--- 無效的日期格式在 {args}，跳過此步驟 ---")
+            return False
+        return True
 
-        print("--- Planner Agent 正在呼叫 LLM 進行思考... ---")
+    @staticmethod
+    def _validate_attraction_call(args: Dict) -> bool:
+        return True
+
+    def _plan_messages(self, current_state: PlanningState) -> List:
+        # 日期範圍直接由 Python 算好再交給 LLM，省下輸出 token 也避免算錯日子；
+        # 只有需求明確寫出「N月」時才算得出範圍，否則不能硬塞本月的日期，改由 LLM 依原本的規則判斷
+        date_ranges = candidate_date_ranges(current_state.user_query)
+        if date_ranges:
+            date_rule = _DATE_RANGES_RULE.format("、".join(f"{start} 至 {end}" for start, end in date_ranges))
+        else:
+            date_rule = _LLM_DATE_RULE
+        return self.PLAN_PROMPT.format_messages(date_rule=date_rule, query=current_state.user_query)
+
+    def _apply_plan(self, current_state: PlanningState, response) -> PlanningState:
+        # 模型回傳的是結構化的 tool call：{"name", "args", "id"}，不需再解析字串
+        print(f"--- LLM 回應的 tool calls: ---\n{response.tool_calls}")
+
+        # 驗證計劃中的工具呼叫：依工具名稱分派到對應的驗證函數
+        validated_plan = []
+        for call in response.tool_calls:
+            validator = self._step_validators.get(call["name"])
+            if validator is None:
+                print(f"--- 未知工具呼叫: {call}，跳過此步驟 ---")
+                continue
+            if validator(call["args"]):
+                validated_plan.append(call)
 
-        response_str = chain.invoke({
-            "tools": self.available_tools,
-            "query": current_state.user_query
-        })
+        current_state.current_plan = validated_plan
+        print(f"--- 成功解析並更新計劃: {validated_plan} ---")
 
-        print(f"--- LLM 回應的原始字串: ---\n{response_str}")
+        return current_state
 
-        response_str = re.sub(r'^```json\n|\n```$', '', response_str).strip()
+    @staticmethod
+    def _deterministic_plan(user_query: str) -> Optional[List[Dict]]:
+        """
+        計劃其實只是 日期範圍 × {search_flights, search_hotels} 加上每個興趣一次 search_attractions，
+        需求中找得到目的地 (已知城市) 且明確寫出「N月」時直接用程式產生；否則回傳 None，改由 LLM 規劃。
+        """
+        # 只提到一個城市時當作目的地；提到兩個時必須有「從X」或「X出發」標出出發地，
+        # 不能靠出現順序判斷 (例如「東京五天四夜，台北出發」)，無法判斷就交給 LLM
+        cities = [city for city in CITY_TO_AIRPORT_CODE if city in user_query]
+        # 沒有明確月份 (例如「下個月」、「12/20 出發」) 時為空串列，不能擅自用本月代替
+        date_ranges = candidate_date_ranges(user_query)
+        if not cities or not date_ranges:
+            return None
+        if len(cities) == 1:
+            departure, destination = DEFAULT_DEPARTURE_CITY, cities[0]
+            if destination == departure:
+                return None
+        elif len(cities) == 2:
+            marked = [city for city in cities if f"從{city}" in user_query or f"{city}出發" in user_query]
+            if len(marked) != 1:
+                return None
+            departure = marked[0]
+            destination = cities[1] if departure == cities[0] else cities[0]
+        else:
+            return None
+
+        calls = []
+        for start, end in date_ranges:
+            calls.append({"name": "search_flights", "args": {
+                "departure_city": departure, "destination_city": destination,
+                "departure_date": start, "return_date": end,
+            }})
+            calls.append({"name": "search_hotels", "args": {
+                "destination": destination, "checkin_date": start, "checkout_date": end,
+            }})
+        for interest in INTEREST_KEYWORDS:
+            if interest in user_query:
+                calls.append({"name": "search_attractions", "args": {"destination": destination, "interest": interest}})
+        return [dict(call, id=f"plan_{i}") for i, call in enumerate(calls)]
 
-        try:
-            response_json = json.loads(response_str)
-            plan = response_json.get("plan", [])
-
-            # 驗證計劃中的工具呼叫
-            validated_plan = []
-            for step in plan:
-                if "search_flights" in step:
-                    if "departure_date=" in step:
-                        date_match = re.search(r'departure_date="(\d{4}-\d{2}-\d{2})"', step)
-                        if not date_match or not self.is_valid_date(date_match.group(1)):
-                            print(f"--- 無效的日期格式在 {step}，跳過此步驟 ---")
-                            continue
-                    if "return_date=" in step and "return_date=\"None\"" not in step:
-                        date_match = re.search(r'return_date="(\d{4}-\d{2}-\d{2})"', step)
-                        if not date_match or not self.is_valid_date(date_match.group(1)):
-                            print(f"--- 無效的回程日期格式在 {step}，跳過此步驟 ---")
-                            continue
-                    validated_plan.append(step)
-                elif "search_hotels" in step:
-                    if "checkin_date=" in step and "checkout_date=" in step:
-                        checkin_match = re.search(r'checkin_date="(\d{4}-\d{2}-\d{2})"', step)
-                        checkout_match = re.search(r'checkout_date="(\d{4}-\d{2}-\d{2})"', step)
-                        if not checkin_match or not checkout_match or not self.is_valid_date(checkin_match.group(1)) or not self.is_valid_date(checkout_match.group(1)):
-                            print(f"--- 無效的日期格式在 {step}，跳過此步驟 ---")
-                            continue
-                        validated_plan.append(step)
-                elif "search_attractions" in step:
-                    validated_plan.append(step)
-                else:
-                    print(f"--- 未知工具呼叫: {step}，跳過此步驟 ---")
-
-            current_state.current_plan = validated_plan
-            print(f"--- 成功解析並更新計劃: {validated_plan} ---")
-        except json.JSONDecodeError as e:
-            print(f"--- LLM 回應格式錯誤，無法解析 JSON：{e}。將使用空計劃。 ---")
-            current_state.current_plan = []
+    def generate_initial_plan(self, current_state: PlanningState) -> PlanningState:
+        plan = self._deterministic_plan(current_state.user_query)
+        if plan is not None:
+            current_state.current_plan = plan
+            print(f"--- 需求格式固定，直接產生計劃 (不呼叫 LLM): {plan} ---")
+            return current_state
 
-        return current_state
+        print("--- Planner Agent 正在呼叫 LLM 進行思考... ---")
+        response = self.planner_llm.invoke(self._plan_messages(current_state))
+        return self._apply_plan(current_state, response)
 
-    def execute_plan(self, current_state: PlanningState) -> PlanningState:
-        """執行生成的計劃，調用對應的工具"""
-        print("\n--- 執行計劃 ---")
-        execution_results = []
+    def generate_initial_plans(self, states: List[PlanningState], max_concurrency: int = 8) -> List[PlanningState]:
+        """
+        generate_initial_plan 的批次版本 (例如測試多組需求)：
+        以 batch 同時送出所有請求，總耗時約等於最慢的那一次，而不是逐一等待。
+        """
+        # 可以直接產生計劃的需求不需要呼叫 LLM，只把其餘的送去 batch
+        pending = []
+        for state in states:
+            plan = self._deterministic_plan(state.user_query)
+            if plan is None:
+                pending.append(state)
+            else:
+                state.current_plan = plan
+
+        print(f"--- Planner Agent 正在批次規劃 {len(pending)} 個需求... ---")
+        responses = self.planner_llm.batch(
+            [self._plan_messages(state) for state in pending],
+            config={"max_concurrency": max_concurrency},
+        ) if pending else []
+        for state, response in zip(pending, responses):
+            self._apply_plan(state, response)
+        return states
+
+    def _parse_step(self, step: Dict) -> Optional[Tuple[str, StructuredTool, Dict]]:
+        """把 tool call ({"name", "args", "id"}) 轉成 (工具名稱, 工具, 參數)；找不到工具時回傳 None"""
+        tool_name = step["name"]
+        tool = self._tool_by_name.get(tool_name)
+        if not tool:
+            print(f"--- 找不到工具 {tool_name}，跳過此步驟 ---")
+            return None
+
+        # LLM 偶爾會把 None 寫成字串 "None"
+        params = {key: None if value == "None" else value for key, value in step["args"].items()}
+        return tool_name, tool, params
 
-        for step in current_state.current_plan:
-            print(f"執行步驟: {step}")
-            try:
-                # 解析工具名稱和參數
-                tool_name = step.split("(")[0]
-                tool = next((t for t in self.tools if t.name == tool_name), None)
-                if not tool:
-                    print(f"--- 找不到工具 {tool_name}，跳過此步驟 ---")
-                    continue
+    @staticmethod
+    def _tool_cache_key(tool_name: str, params: Dict) -> str:
+        return hashlib.blake2b(orjson.dumps([tool_name, sorted(params.items())])).hexdigest()
+
+    def _invoke_tool(self, tool_name: str, tool: StructuredTool, params: Dict) -> Dict:
+        """調用單一工具，回傳 {"tool", "params", "result" 或 "error"}"""
+        print(f"執行步驟: {tool_name}({params})")
+        # 查詢類工具 (INFORMATIONAL) 結果只取決於參數，相同呼叫直接使用快取
+        cacheable = tool_name in INFORMATIONAL_TOOLS
+        key = self._tool_cache_key(tool_name, params) if cacheable else None
+        if cacheable:
+            with self._tool_cache_lock:
+                cached = self._tool_cache.get(key)
+            if cached is not None:
+                print(f"--- 工具 {tool_name} 命中快取 ---")
+                return {"tool": tool_name, "params": params, "result": cached}
 
-                # 提取參數
-                param_str = step[step.find("(")+1:step.rfind(")")]
-                params = {}
-                for param in param_str.split(", "):
-                    if "=" in param:
-                        key, value = param.split("=", 1)
-                        # 移除引號並處理 None
-                        value = value.strip('"')
-                        if value == "None":
-                            value = None
-                        params[key] = value
-
-                # 調用工具
-                result = tool.invoke(params)
-                execution_results.append({"tool": tool_name, "params": params, "result": json.loads(result) if isinstance(result, str) else result})
-                print(f"--- 工具 {tool_name} 執行結果: {result} ---")
-            except Exception as e:
-                print(f"--- 執行 {step} 失敗: {str(e)} ---")
-                execution_results.append({"tool": tool_name, "params": params, "error": str(e)})
+        try:
+            result = tool.invoke(params)
+            print(f"--- 工具 {tool_name} 執行結果: {result} ---")
+            result = orjson.loads(result) if isinstance(result, str) else result
+        except Exception as e:
+            print(f"--- 執行 {tool_name} 失敗: {str(e)} ---")
+            return {"tool": tool_name, "params": params, "error": str(e)}
+
+        # 工具回傳的錯誤 (例如 API 暫時失敗) 不快取，下次仍會重試
+        if cacheable and not (isinstance(result, dict) and "error" in result):
+            with self._tool_cache_lock:
+                self._tool_cache[key] = result
+        return {"tool": tool_name, "params": params, "result": result}
 
-            time.sleep(1)
+    def execute_plan(self, current_state: PlanningState) -> PlanningState:
+        """執行生成的計劃，調用對應的工具 (同步入口，內部並行執行)"""
+        return asyncio.run(self.aexecute_plan(current_state))
+
+    async def aexecute_plan(self, current_state: PlanningState) -> PlanningState:
+        """
+        各工具呼叫彼此獨立 (多日期的航班/飯店查詢)，
+        以 asyncio.gather 同時送出，總耗時由 sum(延遲) 降為 max(延遲)。
+        """
+        print("\n--- 執行計劃 (並行) ---")
+        # 先一次解析所有步驟，再同時派送
+        parsed_steps = [parsed for parsed in map(self._parse_step, current_state.current_plan) if parsed]
+        # 相同 (工具, 參數) 的呼叫只執行一次 (例如每個日期範圍都重複的 search_attractions)，
+        # 結果再對應回每個要求它的步驟
+        step_keys = [self._tool_cache_key(tool_name, params) for tool_name, _, params in parsed_steps]
+        unique_steps = {}
+        for key, parsed in zip(step_keys, parsed_steps):
+            unique_steps.setdefault(key, parsed)
+        loop = asyncio.get_running_loop()
+        unique_results = await asyncio.gather(
+            *[loop.run_in_executor(self._tool_executor, self._invoke_tool, *parsed)
+              for parsed in unique_steps.values()]
+        )
+        results_by_key = dict(zip(unique_steps, unique_results))
+
+        # 依原本的步驟順序組回執行歷史，同一個迴圈裡順便建好以日期為鍵的搜尋結果索引
+        execution_results = []
+        search_results: Dict[str, List[Dict]] = {}
+        for key in step_keys:
+            record = results_by_key[key]
+            execution_results.append(record)
+            if "result" in record:
+                params = record["params"]
+                date_key = params.get("departure_date") or params.get("checkin_date") or params.get("destination")
+                search_results.setdefault(date_key, []).append(record)
 
-        # 更新執行歷史
         current_state.execution_history = execution_results
-        # 儲存搜尋結果，以日期為鍵
-        current_state.search_results = {}
-        for result in execution_results:
-            if "result" in result:
-                date_key = result["params"].get("departure_date") or result["params"].get("checkin_date") or result["params"].get("destination")
-                if date_key not in current_state.search_results:
-                    current_state.search_results[date_key] = []
-                current_state.search_results[date_key].append(result)
+        current_state.search_results = search_results
         return current_state
 
-    def optimize_itinerary(self, current_state: PlanningState) -> PlanningState:
+    async def arun_pipeline(self, current_state: PlanningState, cache: Optional[StateCache] = None,
+                            until: Optional[str] = None) -> PlanningState:
         """
-        (這是修改後的函數)
-        使用 LLM 分析「已被 Python 選出的最佳選項」，並發揮創意生成最終行程。
-        LLM 不再需要計算成本，專注於創意和總結。
+        完整規劃流程；前後階段有資料相依，execute_plan 的工具呼叫會並行，
+        best_option 階段的成本計算與景點整理也會同時進行。
+        若提供 cache，每個階段完成後會寫入磁碟，下次執行可直接從已完成的階段恢復。
+        若提供 until (階段名稱)，執行完該階段後就停止，例如交給 stream_optimize 串流最後一步。
         """
-        print("\n--- LLM 正在分析最佳選項並發揮創意... ---")
+        stages = [
+            ("initial_plan", self.generate_initial_plan),
+            ("execute_plan", self.aexecute_plan),
+            ("best_option", self.afind_best_option),
+            ("itinerary", self.optimize_itinerary),
+        ]
+        if until:
+            stages = stages[:[name for name, _ in stages].index(until) + 1]
+
+        updated_state = current_state
+        # 某個階段一旦重新執行，後面階段的快取是由舊的輸入算出來的，不能再恢復
+        resuming = cache is not None
+        for stage, run_stage in stages:
+            cached_state = cache.resume(stage) if resuming else None
+            if cached_state is not None:
+                print(f"--- 從快取恢復階段 {stage} ---")
+                updated_state = cached_state
+                continue
 
-        # 檢查 Python 計算步驟是否成功
-        if "error" in current_state.final_itinerary:
-            print(f"--- 由於計算錯誤，跳過創意優化: {current_state.final_itinerary['error']} ---")
-            # 狀態已經包含錯誤，直接回傳
-            return current_state
+            resuming = False
+            updated_state = run_stage(updated_state)
+            if asyncio.iscoroutine(updated_state):
+                updated_state = await updated_state
+            if cache:
+                cache.persist(stage, updated_state)
+        return updated_state
 
-        # 提取景點資訊
-        # (修正) 確保 "東京" 這個 key 存在，如果不存在則給一個空列表
-        attractions_results = current_state.search_results.get("東京", [])
-        anime_spots = []
-        food_spots = []
-        for res in attractions_results:
-            if res["tool"] == "search_attractions" and "result" in res:
-                if res["params"].get("interest") == "動漫":
-                    anime_spots.extend(res["result"])
-                elif res["params"].get("interest") == "美食":
-                    food_spots.extend(res["result"])
+    @staticmethod
+    def _extract_spots(current_state: PlanningState) -> Dict[str, List[str]]:
+        """從景點搜尋結果整理出動漫 / 美食景點 (只讀取 search_results，可與 find_best_option 同時執行)"""
+        # 景點結果以目的地為 key，不限定 "東京"：任何目的地的景點都要整理進來
+        spots: Dict[str, List] = {field: [] for field in INTEREST_KEYWORDS.values()}
+        for results in current_state.search_results.values():
+            for res in results:
+                if res["tool"] != "search_attractions" or not isinstance(res.get("result"), list):
+                    continue
+                field = INTEREST_KEYWORDS.get(res["params"].get("interest"))
+                if field:
+                    spots[field].extend(res["result"])
+
+        return {
+            field: [f"{spot.get('title')}: {spot.get('snippet')}" for spot in found[:5]]
+            for field, found in spots.items()
+        }
+
+    # 創意行程只會用到的航班 / 飯店欄位，其餘欄位不放進提示以節省 token
+    _FLIGHT_FIELDS = ("airline", "flight_number", "price", "duration")
+    _HOTEL_FIELDS = ("name", "price", "rating", "address", "description")
+
+    @classmethod
+    def _slim_option(cls, option: Dict) -> Dict:
+        """複製一份選項，只保留航班 / 飯店的白名單欄位 (不修改 state 內的原始資料)"""
+        slim = dict(option)
+        if isinstance(option.get("flight"), dict):
+            slim["flight"] = {k: option["flight"].get(k) for k in cls._FLIGHT_FIELDS}
+        if isinstance(option.get("hotel"), dict):
+            slim["hotel"] = {k: option["hotel"].get(k) for k in cls._HOTEL_FIELDS}
+        return slim
+
+    @classmethod
+    def _itinerary_input(cls, current_state: PlanningState) -> Dict:
+        """整理要交給 LLM 發揮創意的資料 (最佳選項 + 景點)"""
+        # 景點資訊通常已在 afind_best_option 時預先整理好
+        spots = current_state.constraints.get("spots") or cls._extract_spots(current_state)
 
         # 準備傳給 LLM 的資料
         input_data = {
             "user_query": current_state.user_query,
-            "best_option_details": current_state.final_itinerary,
-            "cost_analysis_summary": current_state.constraints.get("cost_analysis", []),
-            "anime_spots": [f"{spot.get('title')}: {spot.get('snippet')}" for spot in anime_spots[:5]],
-            "food_spots": [f"{spot.get('title')}: {spot.get('snippet')}" for spot in food_spots[:5]],
+            "best_option_details": cls._slim_option(current_state.final_itinerary),
+            # 其他日期只需要價格做比較，不必附上完整的航班 / 飯店資料
+            "cost_analysis_summary": [
+                {"date_range": o.get("date_range"), "total_cost": o.get("total_cost")}
+                for o in current_state.constraints.get("cost_analysis", [])
+            ],
+            "anime_spots": spots["anime_spots"],
+            "food_spots": spots["food_spots"],
         }
+        return input_data
 
-        # --- ***【錯誤修正】*** ---
-        # 1. 將 "human" 訊息改為 placeholder "{input_json}"
-        # 2. 將 system prompt 中所有範例的 {var} 改為 {{var}} 來跳脫
-        prompt_template = ChatPromptTemplate.from_messages(
-            [
-                (
-                    "system",
-                    """你是一位頂級的東京旅遊規劃師，風格風趣且貼心。
-                    你的任務不是計算價格（Python 已經算好了），而是將「數據」轉化為「美好的回憶」。
-
-                    **你的輸入資料包含：**
-                    1.  `user_query`: 使用者的原始需求 (例如：他對什麼感興趣)。
-                    2.  `best_option_details`: Python 幫你算出的「CP值最高」的機票和飯店。
-                    3.  `cost_analysis_summary`: (選用) 其他日期的價格，讓你知道這個選項有多划算。
-                    4.  `anime_spots`: 動漫景點列表。
-                    5.  `food_spots`: 美食景點列表。
-
-                    **你的工作：**
-                    1.  **總結與確認**：以熱情的口吻告訴使用者，你已經幫他找到了最划算的日期，並簡要總結航班和飯店 (例如：飯店的特色、評分)。
-                    2.  **創意行程**：根據使用者的興趣 (例如 `user_query` 提到的動漫、美食)，將 `anime_spots` 和 `food_spots` 融合到一個五天四夜的行程中。
-                    3.  **主題包裝**：如果使用者提到特定興趣 (如動漫)，嘗試規劃一個「主題日」，例如「秋葉原動漫聖地巡禮日」。
-                    4.  **動態應變**：(如果 `best_option_details` 中有 `error` 欄位) 程式在抓取資料時出錯了，你需要安撫使用者，並根據現有資訊提供替代方案 (例如：建議手動查詢 Airbnb，或更換景點)。
-
-                    **輸出格式：** 必須是純 JSON 格式，不含任何 Markdown。
-                    {{
-                        "title": "為你量身打造的東京五天四夜之旅！",
-                        "summary": "（你對這個行程的總結，例如：我幫你找到了 12/18 出發的最棒組合，住在超方便的新宿，總花費才 TWD XXXXX！）",
-                        "chosen_option": {{
-                            "date_range": "YYYY-MM-DD 至 YYYY-MM-DD",
-                            "total_cost": 12345,
-                            "flight": "（航班資訊，例如：搭乘 華航 CI100 前往成田）",
-                            "hotel": "（飯店資訊，例如：入住 新宿格拉斯麗飯店，評分 4.5/5，哥吉拉在等你！）」"
-                        }},
-                        "itinerary": [
-                            {{"day": 1, "theme": "抵達與探索", "activities": ["搭乘 {{flight}} 抵達東京", "入住 {{hotel}}", "晚餐：{{food_spot}}"]}},
-                            {{"day": 2, "theme": "動漫聖地巡禮", "activities": ["上午：{{anime_spot_1}}", "下午：{{anime_spot_2}}", "晚餐：{{food_spot}}"]}},
-                            {{"day": 3, "theme": "美食與文化", "activities": ["上午：{{spot_3}}", "下午：{{spot_4}}", "晚餐：{{food_spot}}"]}},
-                            {{"day": 4, "theme": "...待定...", "activities": ["..."]}},
-                            {{"day": 5, "theme": "伴手禮與返程", "activities": ["..."]}}
-                        ],
-                        "tips": "（給予使用者一些貼心提醒）"
-                    }}
-                    """
-                ),
-                # 1. (修正) 這裡使用 placeholder
-                ("human", "{input_json}"),
-            ]
-        )
-        # --- ***【修正結束】*** ---
-
-        chain = prompt_template | self.llm | StrOutputParser()
-
-        # 2. (修正) 將 input_data 透過 'input_json' 傳入 invoke
-        response_str = chain.invoke({
-            "input_json": json.dumps(input_data, ensure_ascii=False)
-        })
-
+    @staticmethod
+    def _apply_creative_plan(current_state: PlanningState, response_str: str) -> PlanningState:
+        """解析 LLM 回應的創意行程 JSON，合併回 final_itinerary"""
         print(f"--- LLM 創意行程回應 (原始): ---\n{response_str}")
 
         # --- 使用你強大的 JSON 提取方法 ---
-        json_match = re.search(r'\{.*\}', response_str, re.DOTALL)
-        if not json_match:
+        # 取第一個 "{" 到最後一個 "}" (與貪婪的 r'\{.*\}' 結果相同，但只需線性掃描、不會回溯)
+        start, end = response_str.find("{"), response_str.rfind("}")
+        if start == -1 or end < start:
             print(f"--- LLM 回應中找不到 JSON 區塊 ---")
             current_state.final_itinerary["error_message"] = "LLM 創意規劃失敗"
             return current_state
 
-        response_str = json_match.group(0)
+        response_str = response_str[start:end + 1]
         # --- JSON 提取結束 ---
 
         try:
             # 將 LLM 的創意行程 (JSON) 與 Python 的計算結果 (Dict) 合併
-            creative_itinerary = json.loads(response_str)
+            creative_itinerary = orjson.loads(response_str)
 
             # 我們保留 Python 算出來的精確數字，但用 LLM 的創意包裝
             # 將 creative_itinerary 的內容更新回 current_state.final_itinerary
@@ -292,88 +525,105 @@ class PlannerAgent:
             current_state.global_score = current_state.final_itinerary.get("total_cost")  # 確保分數仍然是 Python 算的
 
             print(f"--- 成功生成最終創意行程 ---")
-        except json.JSONDecodeError as e:
+        except orjson.JSONDecodeError as e:
             print(f"--- LLM 行程優化回應格式錯誤: {e} ---")
             current_state.final_itinerary["error_message"] = "無法解析 LLM 創意行程"
 
         return current_state
 
-    # def optimize_itinerary(self, current_state: PlanningState) -> PlanningState:
-    #     """使用 LLM 分析搜尋結果，選擇總成本最低的行程，並生成最終行程計劃"""
-    #     prompt_template = ChatPromptTemplate.from_messages(
-    #         [
-    #             (
-    #                 "system",
-    #                 """你是一位頂級的行程規劃師，任務是分析多個日期範圍的航班和飯店搜尋結果，選擇總成本（航班+飯店）最低的行程，並生成最終行程計劃，包含航班、飯店和動漫/美食景點建議。
-    #
-    #                 **輸入資料**：
-    #                 {search_results}
-    #
-    #                 **要求**：
-    #                 1. 計算每個日期範圍的總成本（航班價格 + 飯店價格 * 4晚）。
-    #                 2. 選擇總成本最低的日期範圍。
-    #                 3. 使用動漫和美食景點建議，生成一個五天四夜的行程計劃（每天包含合理的數個活動，不會太少也不至於太趕）。
-    #                 4. 回傳 JSON 格式的最終行程計劃：
-    #                 {{
-    #                     "selected_date_range": {{"start_date": "YYYY-MM-DD", "end_date": "YYYY-MM-DD"}},
-    #                     "total_cost": float,
-    #                     "flights": {{...}},
-    #                     "hotel": {{...}},
-    #                     "itinerary": [
-    #                         {{"day": 1, "activities": ["活動1", "活動2"]}},
-    #                         ...
-    #                     ]
-    #                 }}
-    #                 5.簡單說一下每一個時間段的最小花費，讓使用者明白為何選擇當前的行程
-    #
-    #                 **注意**：
-    #                 - 如果某個日期範圍缺少航班或飯店資料，跳過該範圍。
-    #                 - 航班價格取最低價格，飯店價格取最低價格（每晚）。
-    #                 - 動漫和美食景點從 search_attractions 結果中選擇。
-    #                 - 你的回答必須是純 JSON 格式，不包含任何額外的文字或 Markdown 標記。
-    #                 """,
-    #             ),
-    #         ]
-    #     )
-    #
-    #     chain = prompt_template | self.llm | StrOutputParser()
-    #
-    #     print("--- LLM 正在分析搜尋結果並優化行程... ---")
-    #
-    #     response_str = chain.invoke({
-    #         "search_results": json.dumps(current_state.search_results, ensure_ascii=False)
-    #     })
-    #
-    #     print(f"--- LLM 優化行程回應 (原始): ---\n{response_str}")
-    #
-    #     # --- ***【強力修改】*** ---
-    #     # 舊的清理方法 (太弱):
-    #     # response_str = re.sub(r'^```json\n|\n```$', '', response_str).strip()
-    #
-    #     # 新的提取方法 (更強大):
-    #     # 尋找從第一個 '{' 到最後一個 '}' 的所有內容
-    #     json_match = re.search(r'\{.*\}', response_str, re.DOTALL)
-    #
-    #     if not json_match:
-    #         print(f"--- LLM 回應中找不到 JSON 區塊 ---")
-    #         current_state.final_itinerary = {"error": "LLM 回應中找不到 JSON 區塊"}
-    #         return current_state
-    #
-    #     response_str = json_match.group(0)
-    #     print(f"--- 提取到的 JSON 字串: ---\n{response_str}")
-    #     # --- ***【修改結束】*** ---
-    #
-    #     try:
-    #         final_itinerary = json.loads(response_str)
-    #         current_state.final_itinerary = final_itinerary
-    #         current_state.global_score = final_itinerary.get("total_cost")
-    #         print(f"--- 成功生成最終行程: {final_itinerary} ---")
-    #     except json.JSONDecodeError as e:
-    #         print(f"--- LLM 行程優化回應格式錯誤: {e} ---")
-    #         current_state.final_itinerary = {"error": "無法解析行程優化結果"}
-    #
-    #     return current_state
+    def optimize_itinerary(self, current_state: PlanningState) -> PlanningState:
+        """
+        (這是修改後的函數)
+        使用 LLM 分析「已被 Python 選出的最佳選項」，並發揮創意生成最終行程。
+        LLM 不再需要計算成本，專注於創意和總結。
+        """
+        print("\n--- LLM 正在分析最佳選項並發揮創意... ---")
 
+        # 檢查 Python 計算步驟是否成功
+        if "error" in current_state.final_itinerary:
+            print(f"--- 由於計算錯誤，跳過創意優化: {current_state.final_itinerary['error']} ---")
+            # 狀態已經包含錯誤，直接回傳
+            return current_state
+
+        # 以串流方式呼叫 LLM，JSON 物件一完整就停止接收 (見 _stream_itinerary)
+        for _ in self._stream_itinerary(current_state):
+            pass
+        return current_state
+
+    def optimize_itinerary_batch(self, states: List[PlanningState], max_concurrency: int = 8) -> List[PlanningState]:
+        """optimize_itinerary 的批次版本：計算失敗的需求直接略過，其餘一次 batch 呼叫 LLM"""
+        print(f"\n--- LLM 正在批次規劃 {len(states)} 個創意行程... ---")
+        pending = [state for state in states if "error" not in state.final_itinerary]
+        responses = self.itinerary_chain.batch(
+            [{"input_json": orjson.dumps(self._itinerary_input(state)).decode()} for state in pending],
+            config={"max_concurrency": max_concurrency},
+        )
+        for state, response_str in zip(pending, responses):
+            self._apply_creative_plan(state, response_str)
+        return states
+
+    def stream_optimize(self, current_state: PlanningState) -> Iterator[str]:
+        """
+        optimize_itinerary 的串流版本：邊產生邊 yield LLM 的文字片段，讓 UI 可以即時顯示；
+        串流結束後會把解析好的創意行程寫回 current_state。
+        """
+        print("\n--- LLM 正在分析最佳選項並發揮創意 (串流)... ---")
+
+        if "error" in current_state.final_itinerary:
+            print(f"--- 由於計算錯誤，跳過創意優化: {current_state.final_itinerary['error']} ---")
+            return
+
+        yield from self._stream_itinerary(current_state)
+
+    def _stream_itinerary(self, current_state: PlanningState) -> Iterator[str]:
+        # 語意快取的 key 包含需求與最佳選項；數字簽章 (日期、價格) 必須一致才會命中
+        # 快取只是加速用：embedding API 或 SQLite 出錯時當作沒命中，照常呼叫 LLM
+        cache_key = embedding = None
+        if self.creative_cache is not None:
+            cache_key = orjson.dumps({"q": current_state.user_query, "best": current_state.final_itinerary}).decode()
+            try:
+                embedding = self.creative_cache.embed(cache_key)
+                cached_plan = self.creative_cache.lookup(cache_key, embedding)
+            except Exception as e:
+                print(f"--- 創意行程快取查詢失敗，改為直接呼叫 LLM: {e} ---")
+                embedding = cached_plan = None
+            if cached_plan is not None:
+                cached_str = orjson.dumps(cached_plan).decode()
+                yield cached_str
+                self._apply_creative_plan(current_state, cached_str)
+                return
+
+        # 追蹤最外層 JSON 物件的括號深度，物件一結束就停止接收，
+        # 不必等模型把後面多餘的文字 (例如 ``` 或補充說明) 也產生完
+        chunks = []
+        tracker = _JsonObjectTracker()
+        for chunk in self.itinerary_chain.stream({
+            "input_json": orjson.dumps(self._itinerary_input(current_state)).decode()
+        }):
+            chunks.append(chunk)
+            yield chunk
+            if tracker.feed(chunk):
+                break
+        self._apply_creative_plan(current_state, "".join(chunks))
+
+        creative_plan = current_state.final_itinerary.get("creative_plan")
+        if embedding is not None and creative_plan is not None:
+            try:
+                self.creative_cache.store(cache_key, creative_plan, embedding)
+            except Exception as e:
+                print(f"--- 寫入創意行程快取失敗，略過: {e} ---")
+
+    async def afind_best_option(self, current_state: PlanningState) -> PlanningState:
+        """
+        find_best_option 與景點整理只依賴 execute_plan 的結果、彼此獨立，
+        以 asyncio.gather 同時執行；整理好的景點存在 constraints["spots"] 給 optimize_itinerary 使用。
+        """
+        best_state, spots = await asyncio.gather(
+            asyncio.to_thread(self.find_best_option, current_state),
+            asyncio.to_thread(self._extract_spots, current_state),
+        )
+        best_state.constraints["spots"] = spots
+        return best_state
 
     def find_best_option(self, current_state: PlanningState) -> PlanningState:
         """
@@ -392,7 +642,7 @@ class PlannerAgent:
         for date_key, results in results_by_date.items():
 
             # 確保這是個日期，而不是 "東京" (景點搜尋的 key)
-            if not re.match(r'\d{4}-\d{2}-\d{2}', date_key):
+            if not _ISO_DATE_RE.match(date_key):
                 continue
 
             try:
@@ -404,14 +654,15 @@ class PlannerAgent:
 
                 # 從航班結果中提取最低價 (假設 price 已經是 TWD)
                 # 你的 search_flights.py 裡 price 可能是 None，我們要處理這個
-                valid_prices = [f.get("price") for f in flight_result["result"] if f.get("price") is not None]
-                if not valid_prices:
+                # (一次走訪同時過濾並找出最低價的那筆資料)
+                cheapest_flight_data = min(
+                    (f for f in flight_result["result"] if f.get("price") is not None),
+                    key=lambda f: f["price"], default=None)
+                if cheapest_flight_data is None:
                     print(f"--- 日期 {date_key}: 航班資料中無有效價格，跳過 ---")
                     continue
 
-                cheapest_flight_price = min(valid_prices)
-                cheapest_flight_data = next(
-                    f for f in flight_result["result"] if f.get("price") == cheapest_flight_price)
+                cheapest_flight_price = cheapest_flight_data["price"]
 
                 # 2. 找到該日期的飯店
                 hotel_result = next((r for r in results if r["tool"] == "search_hotels" and "result" in r), None)
@@ -421,26 +672,31 @@ class PlannerAgent:
 
                 # 從飯店結果中提取最低價 (假設是 "per night" 價格)
                 # 你的 search_hotel.py 裡 price 可能是 "-"，我們要處理
-                valid_hotel_prices = [h.get("price") for h in hotel_result["result"] if
-                                      isinstance(h.get("price"), (int, float))]
-                if not valid_hotel_prices:
+                cheapest_hotel_data = min(
+                    (h for h in hotel_result["result"] if isinstance(h.get("price"), (int, float))),
+                    key=lambda h: h["price"], default=None)
+                if cheapest_hotel_data is None:
                     print(f"--- 日期 {date_key}: 飯店資料中無有效價格，跳過 ---")
                     continue
 
-                cheapest_hotel_price_per_night = min(valid_hotel_prices)
-                cheapest_hotel_data = next(
-                    h for h in hotel_result["result"] if h.get("price") == cheapest_hotel_price_per_night)
+                cheapest_hotel_price_per_night = cheapest_hotel_data["price"]
 
-                # 3. 計算總成本 (假設是五天四夜 = 4 晚)
-                total_hotel_cost = cheapest_hotel_price_per_night * 4
+                # 3. 計算總成本：住宿晚數由入住 / 退房日期算出 (三天兩夜 = 2 晚，不固定為 4 晚)
+                hotel_params = hotel_result["params"]
+                nights = (date.fromisoformat(hotel_params["checkout_date"])
+                          - date.fromisoformat(hotel_params["checkin_date"])).days
+                if nights < 1:
+                    print(f"--- 日期 {date_key}: 入住 / 退房日期無效，跳過 ---")
+                    continue
+                total_hotel_cost = cheapest_hotel_price_per_night * nights
                 total_cost = cheapest_flight_price + total_hotel_cost
 
                 analysis = {
-                    "date_range": f"{date_key} 至 {hotel_result['params']['checkout_date']}",
+                    "date_range": f"{date_key} 至 {hotel_params['checkout_date']}",
                     "flight": cheapest_flight_data,
                     "hotel": cheapest_hotel_data,
                     "total_cost": total_cost,
-                    "cost_breakdown": f"航班 TWD {cheapest_flight_price} + 飯店 TWD {cheapest_hotel_price_per_night} x 4晚"
+                    "cost_breakdown": f"航班 TWD {cheapest_flight_price} + 飯店 TWD {cheapest_hotel_price_per_night} x {nights}晚"
                 }
                 cost_analysis.append(analysis)
 
@@ -467,29 +723,7 @@ class PlannerAgent:
 
         return current_state
 
-    # ... (這是你原來的 optimize_itinerary 函數) ...
-
-
-# if __name__ == '__main__':
-#     state = PlanningState(
-#         user_query="今年2025年的十二月我想去東京，幫我找最便宜的五天四夜行程，我對動漫和美食有興趣。"
-#     )
-#     from dotenv import load_dotenv
-#
-#     print("--- 執行本地測試 (main.py) ---")
-#
-#     load_dotenv()  # 讀取你本地的 .env 檔案
-#
-#     # 從環境變數讀取 API key
-#     local_api_key = os.environ.get("OPENAI_API_KEY")
-#     planner = PlannerAgent(api_key=local_api_key)
-#     updated_state = planner.generate_initial_plan(state)
-#     updated_state = planner.execute_plan(updated_state)
-#     updated_state = planner.optimize_itinerary(updated_state)
-#
-#     # 檢視最終狀態
-#     print("\n--- 最終更新後的狀態 ---")
-#     print(updated_state.model_dump_json(indent=2))
+
 if __name__ == '__main__':
     state = PlanningState(
         user_query="今年2026年的二月我想去東京，幫我找最便宜的五天四夜行程，我對動漫和美食有興趣。"
@@ -510,8 +744,8 @@ if __name__ == '__main__':
     # 步驟 2: Python 執行工具 (呼叫 API)
     updated_state = planner.execute_plan(updated_state)
 
-    # *** 步驟 3: (新!) Python 執行精確計算 ***
-    updated_state = planner.find_best_option(updated_state)
+    # *** 步驟 3: (新!) Python 執行精確計算 (同時整理景點資料) ***
+    updated_state = asyncio.run(planner.afind_best_option(updated_state))
 
     # 步驟 4: LLM 發揮創意，規劃行程
     updated_state = planner.optimize_itinerary(updated_state)
@@ -520,4 +754,4 @@ if __name__ == '__main__':
     print("\n--- 最終更新後的狀態 ---")
     # 為了方便閱讀，我們只印出 final_itinerary
     # print(updated_state.model_dump_json(indent=2))
-    print(json.dumps(updated_state.final_itinerary, indent=2, ensure_ascii=False))
\ No newline at end of file
+    print(orjson.dumps(updated_state.final_itinerary, option=orjson.OPT_INDENT_2).decode())
\ No newline at end of file
@@ -0,0 +1,74 @@
+import os
+import glob
+import time
+import hashlib
+from datetime import date
+from typing import Optional
+
+from state.model import PlanningState
+
+# 票價與房價會變動，階段快取最多保留 1 小時 (與工具結果快取的 TTL 一致)
+STATE_CACHE_TTL = 60 * 60
+
+
+def is_failed_state(state: PlanningState) -> bool:
+    """沒有計劃、任何工具呼叫失敗、或沒有產生最佳選項時視為失敗，這種狀態不應被快取"""
+    if not state.current_plan:
+        return True
+    if "error" in state.final_itinerary or "error_message" in state.final_itinerary:
+        return True
+    for record in state.execution_history:
+        result = record.get("result")
+        if "error" in record or (isinstance(result, dict) and "error" in result):
+            return True
+    return False
+
+
+class StateCache:
+    """
+    把每個規劃階段完成後的 PlanningState 存成 JSON 檔，
+    重新執行 (或容器重啟) 時可從已完成的階段恢復，不必再付費呼叫 LLM / 旅遊 API。
+    快取鍵包含今天的日期 (候選日期範圍以今天推算)，且檔案超過 ttl 秒就視為過期；失敗的狀態不會寫入。
+    """
+
+    def __init__(self, user_query: str, cache_dir: str = ".cache", ttl: float = STATE_CACHE_TTL,
+                 today: Optional[date] = None):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        today = today or date.today()
+        self.key = hashlib.sha256(f"{today.isoformat()}|{user_query}".encode("utf-8")).hexdigest()
+
+    def _path(self, stage: str) -> str:
+        return os.path.join(self.cache_dir, f"plan_{self.key}_{stage}.json")
+
+    def resume(self, stage: str) -> Optional[PlanningState]:
+        path = self._path(stage)
+        try:
+            age = time.time() - os.path.getmtime(path)
+        except OSError:
+            return None
+        if age > self.ttl:
+            print(f"--- 快取 {path} 已過期，將重新執行此階段 ---")
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        try:
+            with open(path, encoding="utf-8") as f:
+                return PlanningState.model_validate_json(f.read())
+        except Exception as e:
+            print(f"--- 讀取快取 {path} 失敗，將重新執行此階段: {e} ---")
+            return None
+
+    def persist(self, stage: str, state: PlanningState) -> None:
+        if is_failed_state(state):
+            print(f"--- 階段 {stage} 含有錯誤，不寫入快取 ---")
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(self._path(stage), "w", encoding="utf-8") as f:
+            f.write(state.model_dump_json())
+
+    def clear(self) -> None:
+        for path in glob.glob(os.path.join(self.cache_dir, f"plan_{self.key}_*.json")):
+            os.remove(path)
@@ -56,14 +56,15 @@
 #     except ValidationError as e:
 #         print("創建初始狀態時發生錯誤：")
 #         print(e)
-from pydantic import BaseModel
-from typing import List, Dict, Optional
+from pydantic import BaseModel, Field
+from typing import Any, List, Dict, Optional
 
 class PlanningState(BaseModel):
     user_query: str
-    constraints: Dict = {}
-    current_plan: List[str] = []
-    execution_history: List[Dict] = []
+    # 可變預設值一律用 default_factory，每個實例各自建立新的容器
+    constraints: Dict[str, Any] = Field(default_factory=dict)
+    current_plan: List[Dict[str, Any]] = Field(default_factory=list)  # LLM 回傳的 tool calls：{"name", "args", "id"}
+    execution_history: List[Dict[str, Any]] = Field(default_factory=list)
     global_score: Optional[float] = None
-    search_results: Dict = {}  # 儲存多日期搜尋結果
-    final_itinerary: Dict = {}  # 儲存最終選擇的行程
\ No newline at end of file
+    search_results: Dict[str, List[Dict[str, Any]]] = Field(default_factory=dict)  # 儲存多日期搜尋結果
+    final_itinerary: Dict[str, Any] = Field(default_factory=dict)  # 儲存最終選擇的行程
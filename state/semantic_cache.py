@@ -0,0 +1,91 @@
+import os
+import re
+import orjson
+import math
+import sqlite3
+import threading
+import time
+from typing import List, Optional
+
+from langchain_openai import OpenAIEmbeddings
+
+from utils.dates import cn_to_int
+
+
+def query_signature(query: str) -> str:
+    """
+    取出需求中的所有數字 (年份、月份、天數、夜數…)，中文數字會轉成阿拉伯數字。
+    語意相近但日期不同的需求 (例如 十一月 vs 十二月) 向量相似度仍可能很高，
+    因此命中快取時還必須數字簽章一致。
+    """
+    tokens = re.findall(r"\d+|[一二兩三四五六七八九十]+", query)
+    return ",".join(str(cn_to_int(t) or 0) for t in tokens)
+
+
+def _cosine(a: List[float], b: List[float]) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+
+class SemanticPlanCache:
+    """
+    以 user_query 的 embedding 做語意快取：新需求與過去某筆需求的
+    cosine 相似度超過門檻 (且數字簽章一致) 時，直接回傳當時的規劃結果。
+    資料存在本機 SQLite，筆數不多，直接線性比對即可。
+    規劃結果含有固定日期與當時的票價 / 房價，超過 ttl 秒的資料不再命中。
+    """
+
+    def __init__(self, api_key: str, db_path: str = ".cache/semantic_plans.db",
+                 threshold: float = 0.95, model_name: str = "text-embedding-3-small",
+                 ttl: float = 24 * 60 * 60):
+        self.embeddings = OpenAIEmbeddings(api_key=api_key, model=model_name)
+        self.threshold = threshold
+        self.ttl = ttl
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS plans ("
+                "query TEXT PRIMARY KEY, signature TEXT, embedding TEXT, plan_json TEXT, created_at REAL)"
+            )
+            # 舊版資料表沒有 created_at 欄位：補上欄位，舊資料的值為 NULL，視為已過期
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(plans)")}
+            if "created_at" not in columns:
+                self._conn.execute("ALTER TABLE plans ADD COLUMN created_at REAL")
+            self._conn.commit()
+
+    def embed(self, user_query: str) -> List[float]:
+        return self.embeddings.embed_query(user_query)
+
+    def lookup(self, user_query: str, embedding: Optional[List[float]] = None) -> Optional[dict]:
+        embedding = embedding or self.embed(user_query)
+        signature = query_signature(user_query)
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT query, embedding, plan_json FROM plans WHERE signature = ? AND created_at >= ?",
+                (signature, time.time() - self.ttl),
+            ).fetchall()
+
+        best_sim, best_row = 0.0, None
+        for row in rows:
+            sim = _cosine(embedding, orjson.loads(row[1]))
+            if sim > best_sim:
+                best_sim, best_row = sim, row
+
+        if best_row is None or best_sim < self.threshold:
+            return None
+        print(f"--- 語意快取命中：'{best_row[0]}' (相似度 {best_sim:.3f}) ---")
+        return orjson.loads(best_row[2])
+
+    def store(self, user_query: str, plan: dict, embedding: Optional[List[float]] = None) -> None:
+        embedding = embedding or self.embed(user_query)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO plans (query, signature, embedding, plan_json, created_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (user_query, query_signature(user_query), orjson.dumps(embedding).decode(),
+                 orjson.dumps(plan).decode(), time.time()),
+            )
+            self._conn.commit()
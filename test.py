@@ -7,6 +7,8 @@ from datetime import date, timedelta
 from typing import Dict, Any, List
 from dotenv import load_dotenv
 
+from utils.dates import cn_to_int
+
 # ----------------------
 # Dynamic tool imports with rich error capture
 # ----------------------
@@ -36,16 +38,25 @@ except Exception as e:
 # ----------------------
 # Lightweight CN date normalization (heuristic)
 # ----------------------
-CN_MONTH_MAP = {"一":1,"二":2,"三":3,"四":4,"五":5,"六":6,"七":7,"八":8,"九":9,"十":10,"十一":11,"十二":12}
+_CN_MONTH_CHARS = set("一二三四五六七八九十")
+_DIGITS = set("0123456789")
+_NIGHTS_RE = re.compile(r"(\d+)天(\d+)夜")
+_DAYS_RE = re.compile(r"(\d+)天")
 
 def _parse_month(query: str) -> int | None:
-    m = re.search(r"([一二三四五六七八九十]{1,3}|\d{1,2})月", query)
-    if not m: return None
-    tok = m.group(1)
-    if tok.isdigit():
-        v = int(tok)
-        return v if 1 <= v <= 12 else None
-    return CN_MONTH_MAP.get(tok)
+    # 找到「月」之後往回看：最多 2 位數字，或最多 3 個中文數字 (不必經過 regex 引擎)
+    i = query.find("月")
+    while i != -1:
+        chars, limit = (_DIGITS, 2) if i > 0 and query[i-1] in _DIGITS else (_CN_MONTH_CHARS, 3)
+        j = i
+        while j > 0 and i - j < limit and query[j-1] in chars:
+            j -= 1
+        tok = query[j:i]
+        if tok:
+            v = cn_to_int(tok)
+            return v if v is not None and 1 <= v <= 12 else None
+        i = query.find("月", i + 1)
+    return None
 
 def _first_future_day_in_month(year: int, month: int, today: date) -> date:
     d = date(year, month, 1)
@@ -57,10 +68,10 @@ def _first_future_day_in_month(year: int, month: int, today: date) -> date:
     return d
 
 def _extract_len_nights(query: str) -> int | None:
-    m = re.search(r"(\d+)天(\d+)夜", query)
+    m = _NIGHTS_RE.search(query)
     if m:
         return int(m.group(2))
-    m2 = re.search(r"(\d+)天", query)
+    m2 = _DAYS_RE.search(query)
     if m2:
         d = max(1, int(m2.group(1)))
         return max(1, d-1)
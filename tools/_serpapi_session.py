@@ -0,0 +1,84 @@
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+SERPAPI_URL = "https://serpapi.com/search.json"
+
+# 所有 SerpApi 工具共用同一個連線池：並行查詢時重用 TCP/TLS 連線，不必每次重新握手
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=32,
+    max_retries=Retry(total=3, backoff_factor=0.2, status_forcelist=(500, 502, 503, 504)),
+))
+
+# 斷路器：連續失敗 _FAIL_MAX 次 (或收到 429) 後，_RESET_TIMEOUT 秒內直接拒絕，不再送出注定失敗的請求。
+# 時間到後只放行一個請求試探 (half-open)，其餘請求在試探結束前照樣拒絕：成功就歸零，失敗就立刻再斷開。
+_FAIL_MAX = 5
+_RESET_TIMEOUT = 30.0
+_breaker_lock = threading.Lock()
+_consecutive_failures = 0
+_open_until = 0.0
+_probe_in_flight = False
+
+
+class SerpApiUnavailable(requests.RequestException):
+    """斷路器開啟或被 SerpApi 限流時拋出；沿用 RequestException，各工具原本的網路錯誤處理即可接住。"""
+
+
+def _record_failure(open_for: float = 0.0, probe: bool = False):
+    global _consecutive_failures, _open_until, _probe_in_flight
+    with _breaker_lock:
+        _consecutive_failures += 1
+        if probe:
+            _probe_in_flight = False
+        if probe or _consecutive_failures >= _FAIL_MAX:
+            open_for = max(open_for, _RESET_TIMEOUT)
+        if open_for:
+            _open_until = time.monotonic() + open_for
+
+
+def _retry_after(resp: requests.Response) -> float:
+    # Retry-After 也可能是 HTTP 日期格式，這裡只處理秒數，其餘退回預設的 _RESET_TIMEOUT
+    try:
+        return float(resp.headers.get("Retry-After", ""))
+    except ValueError:
+        return _RESET_TIMEOUT
+
+
+def serpapi_search(params: dict, timeout: float = 10) -> dict:
+    """
+    取代 serpapi.GoogleSearch(params).get_dict()：直接以共用的 SESSION 呼叫 SerpApi。
+    API 錯誤 (例如額度用完) 時 SerpApi 仍會回傳含 "error" 欄位的 JSON，這裡不額外 raise；
+    斷路器開啟或遇到 429 時則拋出 SerpApiUnavailable。
+    """
+    global _consecutive_failures, _open_until, _probe_in_flight
+    with _breaker_lock:
+        remaining = _open_until - time.monotonic()
+        # _open_until 有值但已過期：斷路器處於 half-open，只讓搶到旗標的這個請求去試探
+        probe = remaining <= 0 and _open_until > 0
+        if probe and _probe_in_flight:
+            raise SerpApiUnavailable("SerpApi 正在試探是否恢復，請稍後再試")
+        if probe:
+            _probe_in_flight = True
+    if remaining > 0:
+        raise SerpApiUnavailable(f"SerpApi 暫停呼叫中，約 {remaining:.0f} 秒後再試")
+
+    try:
+        resp = SESSION.get(SERPAPI_URL, params=params, timeout=timeout)
+    except Exception:
+        # 不只 RequestException：試探請求無論因何失敗都必須釋放旗標，否則斷路器會永遠卡在 half-open
+        _record_failure(probe=probe)
+        raise
+
+    if resp.status_code == 429:
+        _record_failure(_retry_after(resp), probe=probe)
+        raise SerpApiUnavailable("SerpApi 速率限制 (429)")
+
+    with _breaker_lock:
+        _consecutive_failures = 0
+        _open_until = 0.0
+        _probe_in_flight = False
+    return resp.json()
@@ -1,16 +1,10 @@
 # dispatcher.py
 import json
-from importlib.util import spec_from_file_location, module_from_spec
 
-# 動態載入你的檔案（不改檔名）
-def _load_module(path, mod_name):
-    spec = spec_from_file_location(mod_name, path)
-    mod = module_from_spec(spec)
-    spec.loader.exec_module(mod)
-    return mod
-
-_flights_mod = _load_module("tools/search_flights.py", "search_flights_mod")
-_hotels_mod  = _load_module("tools/search_hotel.py", "search_hotel_mod")
+# 工具都在 tools/ 底下，直接 import 即可 (走 Python 的模組快取，
+# 不會像 spec_from_file_location + exec_module 那樣每次都重新執行整個模組)
+from tools.search_flights import search_flights
+from tools.search_hotel import search_hotels
 
 # def call_tool(tool_name: str, args: dict):
 #     if tool_name == "search_flights":
@@ -31,15 +25,13 @@ _hotels_mod  = _load_module("tools/search_hotel.py", "search_hotel_mod")
 def call_tool(tool_name: str, args: dict):
     print(f"調用工具: {tool_name}，參數: {args}")
     if tool_name == "search_flights":
-        tool = getattr(_flights_mod, "search_flights")
-        fn = getattr(tool, "invoke", tool)
+        fn = getattr(search_flights, "invoke", search_flights)
         result = fn(args)
         print(f"search_flights 回傳: {result}")
         return json.loads(result) if isinstance(result, str) else result
 
     if tool_name == "search_hotels":
-        tool = getattr(_hotels_mod, "search_hotels")
-        fn = getattr(tool, "invoke", tool)
+        fn = getattr(search_hotels, "invoke", search_hotels)
         result = fn(args)
         print(f"search_hotels 回傳: {result}")
         return json.loads(result) if isinstance(result, str) else result
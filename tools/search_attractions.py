@@ -1,31 +1,36 @@
 import os
-import json
+import orjson
 import logging
-from serpapi import GoogleSearch
+from typing import List, Union
+from tools._serpapi_session import serpapi_search
 from langchain.tools import tool
 from pydantic import BaseModel, Field
 from dotenv import load_dotenv
 
-logging.basicConfig(level=logging.INFO)
+# 預設只輸出 WARNING 以上，需要追查時以 LOGLEVEL=INFO / DEBUG 開啟
+logging.basicConfig(level=os.getenv("LOGLEVEL", "WARNING").upper())
 logger = logging.getLogger(__name__)
 
+# .env 只在模組載入時讀一次，API key 也只取一次
+load_dotenv()
+_SERPAPI_KEY = os.getenv("SERPAPI_API_KEY")
+
 class AttractionSearchInput(BaseModel):
     destination: str = Field(description="目的地城市，例如 '東京'")
     interest: str = Field(description="興趣類型，例如 '動漫' 或 '美食'")
 
 @tool(args_schema=AttractionSearchInput)
-def search_attractions(destination: str, interest: str) -> str:
+def search_attractions(destination: str, interest: str) -> Union[List[dict], dict]:
     """
     搜尋指定目的地的興趣相關景點（例如動漫、美食）。
-    回傳包含前5個景點資訊的JSON字串。
+    回傳前5個景點資訊的列表；失敗時回傳 {"error": ...}。
     """
     logger.info(f"搜尋 {destination} 的 {interest} 相關景點")
 
     # 檢查環境變數
-    api_key = os.getenv("SERPAPI_API_KEY")
-    if not api_key:
+    if not _SERPAPI_KEY:
         logger.error("請先設定 SERPAPI_API_KEY 在 .env 檔案")
-        return json.dumps({"error": "請先設定 SERPAPI_API_KEY 在 .env 檔案"})
+        return {"error": "請先設定 SERPAPI_API_KEY 在 .env 檔案"}
 
     # SerpApi 查詢參數
     params = {
@@ -33,23 +38,23 @@ def search_attractions(destination: str, interest: str) -> str:
         "q": f"{destination} {interest} 景點",
         "hl": "zh-tw",
         "gl": "tw",
-        "api_key": api_key
+        "api_key": _SERPAPI_KEY
     }
 
     try:
-        search = GoogleSearch(params)
-        results = search.get_dict()
-        logger.debug(f"API 回傳結果: {json.dumps(results, ensure_ascii=False, indent=2)[:500]}...")
+        results = serpapi_search(params)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("API 回傳結果: %.500s...", orjson.dumps(results, option=orjson.OPT_INDENT_2).decode())
 
         if "error" in results:
             logger.error(f"API 錯誤: {results['error']}")
-            return json.dumps({"error": f"API 錯誤: {results['error']}"})
+            return {"error": f"API 錯誤: {results['error']}"}
 
         # 提取景點資料
         organic_results = results.get("organic_results", [])[:5]
         if not organic_results:
-            logger.warning(f"無 {interest} 相關景點資料返回，params: {params}")
-            return json.dumps({"error": f"在 {destination} 找不到 {interest} 相關景點"})
+            logger.warning("無 %s 相關景點資料返回: %s", interest, destination)
+            return {"error": f"在 {destination} 找不到 {interest} 相關景點"}
 
         simplified_results = []
         for result in organic_results:
@@ -59,8 +64,8 @@ def search_attractions(destination: str, interest: str) -> str:
                 "snippet": result.get("snippet", "-")
             })
 
-        return json.dumps(simplified_results, ensure_ascii=False)
+        return simplified_results
 
     except Exception as e:
         logger.error(f"搜尋景點失敗: {str(e)}")
-        return json.dumps({"error": f"搜尋景點失敗: {str(e)}"})
\ No newline at end of file
+        return {"error": f"搜尋景點失敗: {str(e)}"}
\ No newline at end of file
@@ -1,21 +1,53 @@
 import os
 import json
+import orjson
 import requests
+from datetime import date
 from dateutil.parser import parse
-from serpapi.google_search import GoogleSearch
+from tools._serpapi_session import serpapi_search
 from langchain.tools import tool
 from pydantic import BaseModel, Field
 from dotenv import load_dotenv
 import logging
+from types import MappingProxyType
+from typing import List, Union
 
-logging.basicConfig(level=logging.INFO)
+# 預設只輸出 WARNING 以上，需要追查時以 LOGLEVEL=INFO / DEBUG 開啟
+logging.basicConfig(level=os.getenv("LOGLEVEL", "WARNING").upper())
 logger = logging.getLogger(__name__)
 
-CITY_TO_AIRPORT_CODE = {
+# .env 只在模組載入時讀一次，API key 也只取一次，不必每次搜尋都重新讀檔
+load_dotenv()
+_SERPAPI_KEY = os.getenv("SERPAPI_API_KEY")
+
+# 唯讀的城市 -> 機場代碼對照表
+CITY_TO_AIRPORT_CODE = MappingProxyType({
     "東京": "NRT",
     "大阪": "KIX",
-    "台北": "TPE"
-}
+    "台北": "TPE",
+    "福岡": "FUK",
+    "札幌": "CTS",
+    "名古屋": "NGO",
+})
+
+def _code(city: str) -> str:
+    # 已知城市轉成機場代碼；本來就是 IATA 代碼 (例如 "HND") 則直接使用；其他一律視為錯誤，不送出 SerpApi 查詢
+    city = city.strip()
+    code = CITY_TO_AIRPORT_CODE.get(city)
+    if code:
+        return code
+    if len(city) == 3 and city.isascii() and city.isupper():
+        return city
+    raise ValueError(f"不支援的城市：{city}")
+
+def _normalize_date(date_str: str) -> str:
+    # 已經是 YYYY-MM-DD 就直接驗證 (規劃器送來的幾乎都是這種格式)，其他格式才交給 dateutil 解析
+    if len(date_str) == 10 and date_str[4] == "-" and date_str[7] == "-":
+        try:
+            return date(int(date_str[:4]), int(date_str[5:7]), int(date_str[8:10])).isoformat()
+        except ValueError:
+            pass
+    return parse(date_str).strftime("%Y-%m-%d")
 
 class FlightSearchInput(BaseModel):
     departure_city: str = Field(description="出發城市，例如 '台北'")
@@ -24,28 +56,29 @@ class FlightSearchInput(BaseModel):
     return_date: str = Field(description="回程日期，格式為 YYYY-MM-DD 或其他可解析格式，選填", default=None)
 
 @tool(args_schema=FlightSearchInput)
-def search_flights(departure_city: str, destination_city: str, departure_date: str, return_date: str = None) -> str:
+def search_flights(departure_city: str, destination_city: str, departure_date: str, return_date: str = None) -> Union[List[dict], dict]:
     """
     根據出發城市、目的地城市、出發日期和回程日期（可選）搜尋航班資訊。
     日期格式應為 YYYY-MM-DD 或其他可解析格式。
-    回傳包含前5個最相關航班資訊的JSON字串。
+    回傳前5個最相關航班資訊的列表；失敗時回傳 {"error": ...}。
     """
-    load_dotenv()
     logger.info(f"正在執行搜尋航班工具：從 {departure_city} 到 {destination_city}, 出發日期 {departure_date}, 回程日期 {return_date}")
 
     try:
-        departure_date = parse(departure_date).strftime("%Y-%m-%d")
+        departure_date = _normalize_date(departure_date)
         if return_date:
-            return_date = parse(return_date).strftime("%Y-%m-%d")
+            return_date = _normalize_date(return_date)
     except ValueError:
-        return json.dumps({"error": "無法解析日期格式，請使用 YYYY-MM-DD 或其他有效格式"})
+        return {"error": "無法解析日期格式，請使用 YYYY-MM-DD 或其他有效格式"}
 
-    api_key = os.getenv("SERPAPI_API_KEY")
-    if not api_key:
-        return json.dumps({"error": "找不到 SERPAPI_API_KEY"})
+    if not _SERPAPI_KEY:
+        return {"error": "找不到 SERPAPI_API_KEY"}
 
-    departure_id = CITY_TO_AIRPORT_CODE.get(departure_city, departure_city)
-    arrival_id = CITY_TO_AIRPORT_CODE.get(destination_city, destination_city)
+    try:
+        departure_id = _code(departure_city)
+        arrival_id = _code(destination_city)
+    except ValueError as e:
+        return {"error": str(e)}
 
     params = {
         "engine": "google_flights",
@@ -55,7 +88,7 @@ def search_flights(departure_city: str, destination_city: str, departure_date: s
         #"outbound_time": departure_time,
         "return_date": return_date,
         #"return_time": retur_time,
-        "api_key": api_key,
+        "api_key": _SERPAPI_KEY,
         "hl": "zh-tw",
         "type": "1" if return_date else "2" ,
         "bags":"1",
@@ -65,14 +98,14 @@ def search_flights(departure_city: str, destination_city: str, departure_date: s
         params["return_date"] = return_date
 
     try:
-        search = GoogleSearch(params)
-        results = search.get_dict()
-        logger.debug(f"API 回傳結果: {json.dumps(results, ensure_ascii=False, indent=2)}")
+        results = serpapi_search(params)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("API 回傳結果: %s", orjson.dumps(results, option=orjson.OPT_INDENT_2).decode())
 
         if "error" in results:
-            return json.dumps({"error": f"API 錯誤: {results['error']}"})
+            return {"error": f"API 錯誤: {results['error']}"}
         if "best_flights" not in results and "other_flights" not in results:
-            return json.dumps({"error": f"找不到從 {departure_id} 到 {arrival_id} 在 {departure_date} 的航班資訊"})
+            return {"error": f"找不到從 {departure_id} 到 {arrival_id} 在 {departure_date} 的航班資訊"}
 
         flights_to_process = (results.get("best_flights", []) + results.get("other_flights", []))[:5]
 
@@ -100,23 +133,19 @@ def search_flights(departure_city: str, destination_city: str, departure_date: s
                 "arrival_time": arrival_time
             })
 
-        return json.dumps(simplified_results, ensure_ascii=False)
+        return simplified_results
 
     except requests.RequestException as e:
-        return json.dumps({"error": f"網路錯誤: {str(e)}"})
+        return {"error": f"網路錯誤: {str(e)}"}
     except json.JSONDecodeError:
-        return json.dumps({"error": "無法解析 API 回傳的 JSON 資料"})
+        return {"error": "無法解析 API 回傳的 JSON 資料"}
 
-from dotenv import load_dotenv
-import json
 from pprint import pprint
 
 def test_flight_search():
-    load_dotenv()
-
     print("=== 測試案例 1：單程航班（台北 -> 東京） ===")
     result = search_flights.run({"departure_city": "台北", "destination_city": "東京", "departure_date": "2025-10-20"})
-    flights = json.loads(result) if isinstance(result, str) else result
+    flights = orjson.loads(result) if isinstance(result, str) else result
     if "error" in flights:
         print(flights["error"])
     else:
@@ -130,7 +159,7 @@ def test_flight_search():
         "departure_date": "2025-10-20",
         "return_date": "2025-10-27"
     })
-    flights = json.loads(result) if isinstance(result, str) else result
+    flights = orjson.loads(result) if isinstance(result, str) else result
     if "error" in flights:
         print(flights["error"])
     else:
@@ -138,7 +167,6 @@ def test_flight_search():
             print(f"航班 {i}: 航空公司={flight['airline']}, 航班號={flight['flight_number']}, 價格={flight['price']}元, 時間={flight['duration']}分鐘, 中轉={flight['stops']}, 出發={flight['departure_time']}, 抵達={flight['arrival_time']}")
 
 def flight_search(de_city="台北" , arr_city="東京" , de_date="2025-10-08" , re_date="2025-10-12"):
-    load_dotenv()
     tool_input = {
         "departure_city": de_city,
         "destination_city": arr_city,
@@ -146,7 +174,7 @@ def flight_search(de_city="台北" , arr_city="東京" , de_date="2025-10-08" ,
         "return_date": re_date
     }
     result = search_flights.invoke(tool_input)
-    flights = json.loads(result) if isinstance(result, str) else result
+    flights = orjson.loads(result) if isinstance(result, str) else result
     if "error" in flights:
         print(flights["error"])
     else:
@@ -1,60 +1,112 @@
 import os
-import json
+import heapq
+import math
+import threading
 import requests
-from datetime import datetime
-from serpapi import GoogleSearch
+from datetime import date, datetime
+from functools import lru_cache
+from types import MappingProxyType
+from cachetools import TTLCache
 from langchain.tools import tool
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 import logging
+from typing import List, Union
 from dotenv import load_dotenv
+from tools._serpapi_session import SERPAPI_URL, serpapi_search
 
-logging.basicConfig(level=logging.INFO)
+# 預設只輸出 WARNING 以上，需要追查時以 LOGLEVEL=INFO / DEBUG 開啟
+logging.basicConfig(level=os.getenv("LOGLEVEL", "WARNING").upper())
 logger = logging.getLogger(__name__)
 
+# .env 只在模組載入時讀一次，API key 也只取一次 (沿用 .env 範本的佔位值視同未設定)
+load_dotenv()
+_SERPAPI_KEY = os.getenv("SERPAPI_API_KEY")
+if _SERPAPI_KEY == "YOUR_SERPAPI_API_KEY":
+    _SERPAPI_KEY = None
+
+# 內容固定的錯誤訊息範本：回傳時一律 dict(...) 複製一份，呼叫端修改回傳值也不會污染共用的物件
+_ERR_NO_KEY = {"error": "⚠️ 請先設定 SERPAPI_API_KEY 在 .env 檔案"}
+_ERR_BAD_SORT_ORDER = {"error": "無效的排序順序：必須是 'asc' 或 'desc'"}
+_ERR_BAD_DATE_FMT = {"error": "日期格式必須為 YYYY-MM-DD"}
+_ERR_BAD_DATE_RNG = {"error": "入住日期必須為未來，且退房日期必須晚於入住日期"}
+
+# 同一目的地/日期的原始 properties 在 TTL 內直接重用 (不同排序方式共用同一筆)，不再重打 SerpApi
+_HOTEL_CACHE: TTLCache = TTLCache(
+    maxsize=int(os.getenv("SEARCH_HOTELS_CACHE_SIZE", "1024")),
+    ttl=int(os.getenv("HOTEL_CACHE_TTL", "900")),
+)
+# 確定查無飯店的組合也記下來 (TTL 較短)，LLM 重試同一組查詢時不必再付費打 API；網路錯誤等暫時性失敗不快取
+_NO_RESULTS_MARKER = "hasn't returned any results"
+_NEG_CACHE: TTLCache = TTLCache(maxsize=512, ttl=int(os.getenv("HOTEL_NEG_CACHE_TTL", "60")))
+_HOTEL_CACHE_LOCK = threading.Lock()  # TTLCache 本身不是執行緒安全的，兩個快取共用這把鎖
+
+# 缺欄位時共用的唯讀空 dict，不必每次 .get(..., {}) 都配置一個新的
+_EMPTY = MappingProxyType({})
+
+# 排序欄位 -> 取值函式；同時也是合法排序欄位的白名單 (方向由 sort_order 另外處理)
+_SORT_KEY_FNS = {
+    "price": lambda p: (p.get("total_rate") or _EMPTY).get("extracted_lowest", math.inf),
+    "rating": lambda p: p.get("overall_rating", -math.inf),
+    "reviews": lambda p: p.get("reviews", -math.inf),
+}
+
+
+@lru_cache(maxsize=256)
+def _parse_ymd(s: str) -> date:
+    # 同一批查詢的日期大量重複，strptime 的結果直接快取
+    return datetime.strptime(s, "%Y-%m-%d").date()
+
+def _simplify(prop: dict) -> dict:
+    # total_rate / gps_coordinates 各取一次，缺的話用 _EMPTY
+    rate = prop.get("total_rate") or _EMPTY
+    gps = prop.get("gps_coordinates") or _EMPTY
+    return {
+        "name": prop.get("name", "-"),
+        "price": rate.get("extracted_lowest", "-"),
+        "rating": prop.get("overall_rating", "-"),
+        "reviews": prop.get("reviews", "-"),
+        "description": prop.get("description", "-"),
+        "address": f"{gps.get('latitude', '-')}, {gps.get('longitude', '-')}"
+    }
+
 class HotelSearchInput(BaseModel):
+    # 參數只讀不改；去掉 LLM 常多帶的前後空白，相同查詢才能命中 _HOTEL_CACHE
+    model_config = ConfigDict(frozen=True, str_strip_whitespace=True)
+
     destination: str = Field(description="目的地城市，例如 '東京'")
     checkin_date: str = Field(description="入住日期，格式為 YYYY-MM-DD")
     checkout_date: str = Field(description="退房日期，格式為 YYYY-MM-DD")
     sort_by: str = Field(default="price", description="排序欄位：'price'（價格）、'rating'（評分）、'reviews'（評論數）")
     sort_order: str = Field(default="asc", description="排序順序：'asc'（升序）或 'desc'（降序）")
 
-@tool(args_schema=HotelSearchInput)
-def search_hotels(destination: str, checkin_date: str, checkout_date: str, sort_by: str = "price", sort_order: str = "asc") -> str:
-    """
-    (真實工具) 根據目的地、入住和退房日期搜尋飯店資訊，並按指定欄位排序。
-    日期格式必須是 YYYY-MM-DD。
-    排序欄位：'price'（價格）、'rating'（評分）、'reviews'（評論數）。
-    排序順序：'asc'（升序）或 'desc'（降序）。
-    此工具會回傳一個包含前5個最相關飯店資訊的JSON字串。
-    """
-    logger.info(f"查詢 {destination} 的飯店（{checkin_date} 至 {checkout_date}），排序：{sort_by} ({sort_order})")
+def _search_hotels_impl(destination: str, checkin_date: str, checkout_date: str, sort_by: str = "price", sort_order: str = "asc") -> Union[List[dict], dict]:
+    # search_hotels 的實際內容；本模組的測試函式直接呼叫，不必經過 LangChain 的 tool 包裝
+    if not _SERPAPI_KEY:
+        logger.error(_ERR_NO_KEY["error"])
+        return dict(_ERR_NO_KEY)
 
-    # 檢查環境變數
-    api_key = os.getenv("SERPAPI_API_KEY", "YOUR_SERPAPI_API_KEY")
-    if api_key == "YOUR_SERPAPI_API_KEY":
-        logger.error("⚠️ 請先設定 SERPAPI_API_KEY 在 .env 檔案")
-        return json.dumps({"error": "⚠️ 請先設定 SERPAPI_API_KEY 在 .env 檔案"})
+    logger.info("查詢 %s 的飯店（%s 至 %s），排序：%s (%s)", destination, checkin_date, checkout_date, sort_by, sort_order)
 
     # 驗證排序參數
-    valid_sort_fields = {"price", "rating", "reviews"}
-    if sort_by not in valid_sort_fields:
-        logger.error(f"無效的排序欄位：{sort_by}，必須是 {valid_sort_fields}")
-        return json.dumps({"error": f"無效的排序欄位：{sort_by}，必須是 {valid_sort_fields}"})
+    if sort_by not in _SORT_KEY_FNS:
+        logger.error("無效的排序欄位：%s，必須是 %s", sort_by, set(_SORT_KEY_FNS))
+        return {"error": f"無效的排序欄位：{sort_by}，必須是 {set(_SORT_KEY_FNS)}"}
     if sort_order not in {"asc", "desc"}:
-        logger.error(f"無效的排序順序：{sort_order}，必須是 'asc' 或 'desc'")
-        return json.dumps({"error": f"無效的排序順序：{sort_order}，必須是 'asc' 或 'desc'"})
+        logger.error("無效的排序順序：%s，必須是 'asc' 或 'desc'", sort_order)
+        return dict(_ERR_BAD_SORT_ORDER)
 
     # 日期驗證
-    current_date = datetime.now()
+    # 只比較日期，避免 datetime.now() 的時分秒讓「今天入住」被誤判為過去
+    current_date = date.today()
     try:
-        checkin_date_obj = datetime.strptime(checkin_date, "%Y-%m-%d")
-        checkout_date_obj = datetime.strptime(checkout_date, "%Y-%m-%d")
+        checkin_date_obj = _parse_ymd(checkin_date)
+        checkout_date_obj = _parse_ymd(checkout_date)
         if checkin_date_obj < current_date or checkout_date_obj <= checkin_date_obj:
-            logger.error("入住日期必須為未來，且退房日期必須晚於入住日期")
-            return json.dumps({"error": "入住日期必須為未來，且退房日期必須晚於入住日期"})
+            logger.error(_ERR_BAD_DATE_RNG["error"])
+            return dict(_ERR_BAD_DATE_RNG)
     except ValueError:
-        logger.error("日期格式必須為 YYYY-MM-DD")
-        return json.dumps({"error": "日期格式必須為 YYYY-MM-DD"})
+        logger.error(_ERR_BAD_DATE_FMT["error"])
+        return dict(_ERR_BAD_DATE_FMT)
 
     # SerpApi 查詢參數
     params = {
@@ -66,66 +118,96 @@ def search_hotels(destination: str, checkin_date: str, checkout_date: str, sort_
         "gl": "tw",
         "adults": 1,
         "currency": "TWD",
-        "api_key": api_key
+        # 只要 _simplify 與排序會用到的欄位，圖片/設施/評論摘要等大量欄位不必傳回來也不必解析
+        "json_restrictor": "properties[].{name, overall_rating, reviews, description, total_rate, gps_coordinates}",
+        "api_key": _SERPAPI_KEY
     }
 
+    cache_key = (destination, checkin_date, checkout_date)
+
     try:
-        # 發送 SerpApi 請求
-        logger.info(f"發送 SerpApi 請求: https://serpapi.com/search with params {params}")
-        search = GoogleSearch(params)
-        results_data = search.get_dict()
-        logger.info(f"SerpApi 回應: {json.dumps(results_data, indent=2)[:500]}...")
-
-        # 檢查 API 回應中的錯誤
-        if "error" in results_data:
-            logger.error(f"API 錯誤: {results_data['error']}")
-            return json.dumps({"error": f"API 錯誤: {results_data['error']}"})
-
-        # 檢查是否有飯店資料
-        if "properties" not in results_data or not results_data["properties"]:
-            logger.warning(f"無飯店資料返回，params: {params}")
-            return json.dumps({"error": f"在 {destination} 找不到符合日期的飯店資訊。"})
-
-        # 處理飯店資料
-        properties = results_data["properties"]
-
-        # 動態排序
-        def get_sort_key(prop):
-            if sort_by == "price":
-                value = prop.get("total_rate", {}).get("extracted_lowest", float("inf"))
-            elif sort_by == "rating":
-                value = prop.get("overall_rating", -float("inf"))
-            else:  # reviews
-                value = prop.get("reviews", -float("inf"))
-            # 處理降序（最高到最低）或升序（最低到最高）
-            return value if sort_order == "asc" else -value
-
-        sorted_properties = sorted(properties, key=get_sort_key)[:5]
+        with _HOTEL_CACHE_LOCK:
+            properties = _HOTEL_CACHE.get(cache_key)
+            negative = _NEG_CACHE.get(cache_key) if properties is None else None
+        if negative is not None:
+            logger.info("飯店查無結果快取命中: %s", cache_key)
+            # 快取裡的 dict 由所有命中者共用，回傳複本
+            return dict(negative)
+
+        if properties is None:
+            # 發送 SerpApi 請求
+            # 不記錄整個 params：裡面含 api_key
+            logger.info("發送 SerpApi 請求: %s (%s, %s ~ %s)", SERPAPI_URL, destination, checkin_date, checkout_date)
+            results_data = serpapi_search(params)
+            # INFO 只記一行摘要；完整回應的預覽留給 DEBUG (repr 截斷即可，不必做 JSON 編碼)
+            logger.info("SerpApi 回傳 %d 間飯店: %s", len(results_data.get("properties") or ()), destination)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("SerpApi 回應: %s...", repr(results_data)[:500])
+
+            # 檢查 API 回應中的錯誤；SerpApi 查無結果時通常回傳 error 而不是空的 properties，
+            # 這種情況和空結果一樣是確定的，交給下面的負快取，其餘錯誤 (額度、限流、金鑰) 不快取
+            api_error = results_data.get("error")
+            no_results = bool(api_error) and _NO_RESULTS_MARKER in api_error
+            if api_error and not no_results:
+                logger.error("API 錯誤: %s", api_error)
+                return {"error": f"API 錯誤: {api_error}"}
+
+            # 檢查是否有飯店資料
+            if no_results or not results_data.get("properties"):
+                logger.warning("無飯店資料返回: %s (%s ~ %s)", destination, checkin_date, checkout_date)
+                negative = {"error": f"在 {destination} 找不到符合日期的飯店資訊。"}
+                with _HOTEL_CACHE_LOCK:
+                    _NEG_CACHE[cache_key] = negative
+                return dict(negative)
+
+            # 處理飯店資料 (只快取成功的原始結果，排序與截取在快取之後做)
+            properties = results_data["properties"]
+            with _HOTEL_CACHE_LOCK:
+                _HOTEL_CACHE[cache_key] = properties
+        else:
+            logger.info("飯店快取命中: %s", cache_key)
+
+        # 動態排序：欄位存取函式與方向只決定一次
+        key_fn = _SORT_KEY_FNS[sort_by]
+        # 處理降序（最高到最低）或升序（最低到最高）
+        sort_sign = 1 if sort_order == "asc" else -1
+
+        # 每間飯店的排序值只取一次，比較時直接查 keys，不必每次都走巢狀 dict
+        keys = [sort_sign * key_fn(p) for p in properties]
+        # 只需要前 5 筆：heapq.nsmallest 是 O(N log 5)，不必把整個列表排序
+        idxs = heapq.nsmallest(5, range(len(properties)), key=keys.__getitem__)
+        sorted_properties = [properties[i] for i in idxs]
 
         # 格式化結果
-        simplified_results = []
-        for prop in sorted_properties:
-            simplified_results.append({
-                "name": prop.get("name", "-"),
-                "price": prop.get("total_rate", {}).get("extracted_lowest", "-"),
-                "rating": prop.get("overall_rating", "-"),
-                "reviews": prop.get("reviews", "-"),
-                "description": prop.get("description", "-"),
-                "address": f"{prop.get('gps_coordinates', {}).get('latitude', '-')}, {prop.get('gps_coordinates', {}).get('longitude', '-')}"
-            })
-
-        return json.dumps(simplified_results, ensure_ascii=False)
+        return [_simplify(prop) for prop in sorted_properties]
 
     except requests.RequestException as e:
-        logger.error(f"網路錯誤: {str(e)}")
-        return json.dumps({"error": f"網路錯誤: {str(e)}"})
+        logger.error("網路錯誤: %s", e)
+        return {"error": f"網路錯誤: {str(e)}"}
     except Exception as e:
-        logger.error(f"未知錯誤: {str(e)}")
-        return json.dumps({"error": f"未知錯誤: {str(e)}"})
+        logger.error("未知錯誤: %s", e)
+        return {"error": f"未知錯誤: {str(e)}"}
 
-def test_hotel_search():
-    load_dotenv()  # 載入 .env 檔案中的 API Key
+@tool(args_schema=HotelSearchInput)
+def search_hotels(destination: str, checkin_date: str, checkout_date: str, sort_by: str = "price", sort_order: str = "asc") -> Union[List[dict], dict]:
+    """
+    (真實工具) 根據目的地、入住和退房日期搜尋飯店資訊，並按指定欄位排序。
+    日期格式必須是 YYYY-MM-DD。
+    排序欄位：'price'（價格）、'rating'（評分）、'reviews'（評論數）。
+    排序順序：'asc'（升序）或 'desc'（降序）。
+    此工具會回傳前5個最相關飯店資訊的列表；失敗時回傳 {"error": ...}。
+    """
+    return _search_hotels_impl(destination, checkin_date, checkout_date, sort_by, sort_order)
 
+def _print_hotels(hotels: Union[List[dict], dict]):
+    if "error" in hotels:
+        print(hotels["error"])
+    else:
+        for j, hotel in enumerate(hotels, 1):
+            print(f"飯店 {j}: 名稱={hotel['name']}, 價格={hotel['price']}元, 評分={hotel['rating']}, 評論數={hotel['reviews']}, 描述={hotel['description']}, 地址={hotel['address']}")
+    print()
+
+def test_hotel_search():
     # 測試不同排序情況
     test_cases = [
         {"destination": "東京", "checkin_date": "2025-10-20", "checkout_date": "2025-10-22", "sort_by": "price", "sort_order": "asc"},
@@ -134,28 +216,12 @@ def test_hotel_search():
     ]
 
     for i, test_case in enumerate(test_cases, 1):
-        logger.info(f"=== 測試案例 {i}：東京飯店搜尋 ({test_case['checkin_date']} 至 {test_case['checkout_date']})，排序：{test_case['sort_by']} ({test_case['sort_order']}) ===")
-        result = search_hotels.invoke(test_case)
-        hotels = json.loads(result) if isinstance(result, str) else result
-        if "error" in hotels:
-            print(hotels["error"])
-        else:
-            for j, hotel in enumerate(hotels, 1):
-                print(f"飯店 {j}: 名稱={hotel['name']}, 價格={hotel['price']}元, 評分={hotel['rating']}, 評論數={hotel['reviews']}, 描述={hotel['description']}, 地址={hotel['address']}")
-        print()
+        logger.info("=== 測試案例 %d：東京飯店搜尋 (%s 至 %s)，排序：%s (%s) ===",
+                    i, test_case['checkin_date'], test_case['checkout_date'], test_case['sort_by'], test_case['sort_order'])
+        _print_hotels(_search_hotels_impl(**test_case))
 
 def hotel_search(des="東京" , start_date="2025-10-08" , end_date="2025-10-12" , sort_by="price"):
-    load_dotenv()
-    case = {"destination": des, "checkin_date": start_date, "checkout_date": end_date, "sort_by": sort_by,"sort_order": "asc"}
-    result = search_hotels.invoke(case)
-    hotels = json.loads(result) if isinstance(result, str) else result
-    if "error" in hotels:
-        print(hotels["error"])
-    else:
-        for j, hotel in enumerate(hotels, 1):
-            print(
-                f"飯店 {j}: 名稱={hotel['name']}, 價格={hotel['price']}元, 評分={hotel['rating']}, 評論數={hotel['reviews']}, 描述={hotel['description']}, 地址={hotel['address']}")
-    print()
+    _print_hotels(_search_hotels_impl(des, start_date, end_date, sort_by, "asc"))
 
 if __name__ == "__main__":
     # test_hotel_search()
@@ -1,4 +1,7 @@
 # tools_spec.py
+import orjson
+from types import MappingProxyType
+
 TOOLS = [
     {
         "type": "function",
@@ -28,7 +31,7 @@ TOOLS = [
                     "destination": {"type": "string", "description": "目的地城市（例如：東京）"},
                     "checkin_date": {"type": "string", "description": "入住日期，YYYY-MM-DD"},
                     "checkout_date": {"type": "string", "description": "退房日期，YYYY-MM-DD"},
-                    "sort_by": {"type": "string", "enum": ["price","rating","distance"], "default": "price"},
+                    "sort_by": {"type": "string", "enum": ["price","rating","reviews"], "default": "price"},
                     "sort_order": {"type": "string", "enum": ["asc","desc"], "default": "asc"}
                 },
                 "required": ["destination","checkin_date","checkout_date"]
@@ -36,3 +39,8 @@ TOOLS = [
         }
     }
 ]
+
+# 工具規格在執行期間固定不變：JSON 只序列化一次，並把清單凍結避免被意外修改
+# (orjson 不支援 MappingProxyType，所以要在凍結之前先 dumps)
+TOOLS_JSON: bytes = orjson.dumps(TOOLS)
+TOOLS = tuple(MappingProxyType(t) for t in TOOLS)
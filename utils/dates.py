@@ -0,0 +1,67 @@
+import re
+import calendar
+from datetime import date, timedelta
+from typing import List, Optional, Tuple
+
+# 日期範圍由 Python 計算，不再交給 LLM 數日子
+CN_NUM_MAP = {"一": 1, "二": 2, "兩": 2, "三": 3, "四": 4, "五": 5, "六": 6, "七": 7, "八": 8, "九": 9}
+MAX_DATE_RANGES = 5
+
+# 預先編譯的正規表示式
+_MONTH_RE = re.compile(r"(\d{1,2}|[一二三四五六七八九十]{1,3})月")
+_YEAR_RE = re.compile(r"(\d{4})年")
+_DAYS_NIGHTS_RE = re.compile(r"(\d+|[一二兩三四五六七八九十]{1,3})天(\d+|[一二兩三四五六七八九十]{1,3})夜")
+
+
+def cn_to_int(tok: str) -> Optional[int]:
+    """阿拉伯數字或 1~99 的中文數字 (例如 "兩"、"十"、"十二"、"二十"、"二十五") 轉成 int，無法解析時回傳 None"""
+    if tok.isdigit():
+        return int(tok)
+    if "十" not in tok:
+        return CN_NUM_MAP.get(tok)
+    tens, _, ones = tok.partition("十")
+    if (tens and tens not in CN_NUM_MAP) or (ones and ones not in CN_NUM_MAP):
+        return None
+    return CN_NUM_MAP.get(tens, 1) * 10 + CN_NUM_MAP.get(ones, 0)
+
+
+def candidate_date_ranges(user_query: str, today: Optional[date] = None) -> List[Tuple[str, str]]:
+    """
+    從需求中取出年份、月份與「N天M夜」，在該月份產生最多 5 個 (出發日, 回程日)，出發日平均分散在整個月。
+    例如 九月份的五天四夜 -> 09-01 ~ 09-05、09-07 ~ 09-11 ... 09-25 ~ 09-29；年份以今天推算，預設 4 晚。
+    需求中沒有明確的「N月」(例如「下個月」、「2027/3」、「12/20 出發」) 時回傳空串列，由呼叫端交給 LLM 判斷。
+    """
+    today = today or date.today()
+    month_match = _MONTH_RE.search(user_query)
+    month = cn_to_int(month_match.group(1)) if month_match else None
+    if not month or not 1 <= month <= 12:
+        return []
+
+    year_match = _YEAR_RE.search(user_query)
+    if year_match:
+        year = int(year_match.group(1))
+    else:
+        # 沒指定年份時取最近一個尚未過去的該月份
+        year = today.year + (month < today.month)
+
+    nights_match = _DAYS_NIGHTS_RE.search(user_query)
+    nights = (cn_to_int(nights_match.group(2)) if nights_match else None) or 4
+
+    # 出發日平均分散在整個月份 (而不是從 1 號開始一段接一段)，且回程日盡量不超出該月
+    first_start = max(date(year, month, 1), today)
+    month_end = date(year, month, calendar.monthrange(year, month)[1])
+    if first_start > month_end:
+        # 指定的月份已經整個過去了
+        return []
+    last_start = month_end - timedelta(days=nights)
+    if first_start > last_start:
+        # 剩下的天數不夠完整的一段行程，至少保留從最早可出發日開始的一組
+        last_start = first_start
+    step = max(1, (last_start - first_start).days // (MAX_DATE_RANGES - 1))
+
+    ranges = []
+    start = first_start
+    while start <= last_start and len(ranges) < MAX_DATE_RANGES:
+        ranges.append((start.isoformat(), (start + timedelta(days=nights)).isoformat()))
+        start += timedelta(days=step)
+    return ranges